@@ -29,6 +29,13 @@ class Seq2SeqAttentionDecoder(AttentionDecode):
         outputs, hidden_state = enc_outputs
         return (outputs.permute(1, 0, 2), hidden_state, enc_valid_lens)
 
+    def reorder_state(self, state, index):
+        # enc_outputs: (batch_size, num_steps, num_hiddens)
+        # hidden_state: (num_layers, batch_size, num_hiddens)
+        enc_outputs, hidden_state, enc_valid_lens = state
+        return [enc_outputs.index_select(0, index), hidden_state.index_select(1, index),
+                None if enc_valid_lens is None else enc_valid_lens.index_select(0, index)]
+
     # X: (batch_size, num_steps, vocab_size)
     def forward(self, X, state):
         # enc_outputs: (batch_size, num_steps, num_hiddens)
@@ -79,11 +86,18 @@ plt.show()
 
 engs = ['go .', "i lost .", 'he\'s calm .', 'i\'m home .']
 fras = ['va !', 'j\'ai perdu .', 'il est calme .', 'je suis chez moi .']
-for eng, fra in zip(engs, fras):
-    translation, dec_attention_weight_seq = common.predict_seq2seq(
-        net, eng, src_vocab, tgt_vocab, num_steps, device, True)
+translations = common.translate_batch(net, engs, src_vocab, tgt_vocab, num_steps, device)
+for eng, fra, translation in zip(engs, fras, translations):
     print(f'{eng} => {translation}, ',
           f'bleu {common.bleu(translation, fra, k=2):.3f}')
+# 束搜索
+translations = common.beam_search(net, engs, src_vocab, tgt_vocab, num_steps, device, beam_size=3)
+for eng, fra, translation in zip(engs, fras, translations):
+    print(f'beam search: {eng} => {translation}, ',
+          f'bleu {common.bleu(translation, fra, k=2):.3f}')
+# 可视化注意力权重时仍逐句预测
+translation, dec_attention_weight_seq = common.predict_seq2seq(
+    net, engs[-1], src_vocab, tgt_vocab, num_steps, device, True)
 
 attention_weights = torch.cat([step[0][0][0] for step in dec_attention_weight_seq], 0).reshape((
     1, 1, -1, num_steps))
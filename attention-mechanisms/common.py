@@ -1,6 +1,8 @@
 import os
 import collections
 import math
+import multiprocessing
+import numpy as np
 import torch
 from d2l import torch as d2l
 from torch import nn
@@ -175,6 +177,20 @@ class Decoder(nn.Module):
     def init_state(self, enc_outputs, *args):
         raise NotImplementedError
 
+    def reorder_state(self, state, index):
+        """按index沿batch维度挑选或重排解码器状态，用于批量解码和束搜索
+
+        默认实现递归处理列表和元组：张量沿第0维挑选，None保持不变，
+        其他对象（如KVCache）调用它自己的index_select(index)；
+        batch不在第0维的状态（如循环神经网络的隐状态）需要在子类中重写"""
+        if state is None:
+            return None
+        if isinstance(state, torch.Tensor):
+            return state.index_select(0, index)
+        if isinstance(state, (list, tuple)):
+            return type(state)(self.reorder_state(s, index) for s in state)
+        return state.index_select(index)
+
     def foward(self, X, state):
         raise NotImplementedError
 
@@ -205,7 +221,7 @@ def sequence_mask(X, valid_len, value=0):
 
 def masked_softmax(X, valid_lens):
     if valid_lens is None:
-        return nn.functional.softmax(X, dim=1)
+        return nn.functional.softmax(X, dim=-1)
     else:
         shape = X.shape
         # 当X形如(batch_size, num_seq, num_word), valid_lens形如(batch_size)时，
@@ -249,26 +265,113 @@ class AdditiveAttention(nn.Module):
         # output: (batch_size, num_queries, value_size)
         return torch.bmm(self.dropout(self.attention_weights), values)
 
+def valid_lens_mask(valid_lens, num_keys):
+    """由有效长度构造可广播的布尔掩码，True表示对应的键参与注意力"""
+    # valid_lens: (batch_size) or (batch_size, num_queries)
+    # mask: (batch_size, num_keys) or (batch_size, num_queries, num_keys)
+    mask = torch.arange(num_keys, device=valid_lens.device) < valid_lens.unsqueeze(-1)
+    if valid_lens.dim() == 1:
+        # mask: (batch_size, 1, num_keys)，沿查询维度广播
+        mask = mask.unsqueeze(1)
+    return mask
+
 # 缩放点积注意力
 class DotProductAttention(nn.Module):
-     def __init__(self, dropout, **kwargs):
-          super(DotProductAttention, self).__init__(**kwargs)
-          self.dropout = nn.Dropout(dropout)
-
-     # queries: (batch_size, num_queries, d)
-     # keys: (batch_size, num_keys, d)
-     # values: (batch_size, num_keys, value_dim)
-     # valid_lens: (batch_size)
-     def forward(self, queries, keys, values, valid_lens=None):
-          d = queries.shape[-1]
-          # keys.transpose(1, 2) 形状为 (batch_size, d, num_keys)
-          # 经过torch.bmm矩阵乘法后，scores 形状为 (batch_size, num_queries, num_keys)
-          # 除以 math.sqrt(d) 是为了缩放点击结果，防止梯度爆炸或消失
-          scores = torch.bmm(queries, keys.transpose(1, 2)) / math.sqrt(d)
-          # attention_weights: (batch_size, num_queries, num_keys)
-          self.attention_weights = masked_softmax(scores, valid_lens)
-          # output: (batch_size, num_queries, value_dim)
-          return torch.bmm(self.dropout(self.attention_weights), values)
+    """缩放点积注意力
+
+    backend='sdpa'时调用PyTorch融合的scaled_dot_product_attention，由PyTorch在
+    flash/memory-efficient/math等实现中选择可用的一个；此时不计算注意力权重，
+    只有keep_weights为True（可视化时）才走显式计算并保存attention_weights。
+    backend='math'或PyTorch版本不支持时，始终按显式公式计算。
+    """
+    def __init__(self, dropout, backend='sdpa', **kwargs):
+        super(DotProductAttention, self).__init__(**kwargs)
+        self.dropout = nn.Dropout(dropout)
+        if not hasattr(nn.functional, 'scaled_dot_product_attention'):
+            backend = 'math'
+        self.backend = backend
+        self.keep_weights = False
+        self.attention_weights = None
+
+    # queries: (..., num_queries, d)
+    # keys: (..., num_keys, d)
+    # values: (..., num_keys, value_dim)
+    # valid_lens: (batch_size) or (batch_size, num_queries)，仅用于3维输入
+    # mask: 可广播到(..., num_queries, num_keys)的布尔掩码，优先于valid_lens
+    def forward(self, queries, keys, values, valid_lens=None, mask=None):
+        if mask is None and valid_lens is not None:
+            mask = valid_lens_mask(valid_lens, keys.shape[-2])
+        if self.backend == 'sdpa' and not self.keep_weights:
+            self.attention_weights = None
+            if mask is None:
+                return nn.functional.scaled_dot_product_attention(
+                    queries, keys, values, dropout_p=self.dropout.p if self.training else 0.0)
+            # 所有键都被遮蔽的行(valid_len为0)在SDPA中输出NaN，而显式计算中各个键的分数都是-1e6，
+            # 权重是均匀的，输出为values的平均值；先让这些行看到所有键，再用平均值替换它们的输出
+            # empty: (..., num_queries, 1)
+            empty = ~mask.any(dim=-1, keepdim=True)
+            output = nn.functional.scaled_dot_product_attention(
+                queries, keys, values, attn_mask=mask | empty,
+                dropout_p=self.dropout.p if self.training else 0.0)
+            return torch.where(empty, values.mean(dim=-2, keepdim=True), output)
+        d = queries.shape[-1]
+        # scores: (..., num_queries, num_keys)
+        scores = torch.matmul(queries, keys.transpose(-2, -1)) / math.sqrt(d)
+        if mask is not None:
+            scores = scores.masked_fill(~mask, -1e6)
+        weights = nn.functional.softmax(scores, dim=-1)
+        if self.keep_weights:
+            # attention_weights: (batch_size * num_heads, num_queries, num_keys)，与多头注意力的旧布局一致
+            self.attention_weights = weights.detach().flatten(0, -3)
+        # output: (..., num_queries, value_dim)
+        return torch.matmul(self.dropout(weights), values)
+
+def keep_attention_weights(net, keep=True):
+    """打开或关闭net中所有DotProductAttention对注意力权重的保存"""
+    for m in net.modules():
+        if isinstance(m, DotProductAttention):
+            m.keep_weights = keep
+
+class KVCache:
+    """解码器自注意力的键值缓存
+
+    预先分配形状为(batch_size, num_heads, max_steps, head_size)的缓冲区，保存已经投影并
+    拆分成多头的键和值。每解码一步只把新词元的键和值原地写入缓冲区，容量不够时按两倍扩容
+    """
+    def __init__(self, max_steps=None):
+        self.max_steps = max_steps
+        self.k, self.v = None, None
+        self.length = 0
+
+    def _reserve(self, k, n):
+        if self.k is None:
+            capacity = max(self.max_steps or 0, n)
+        else:
+            capacity = max(2 * self.k.shape[2], self.length + n)
+        k_buf, v_buf = [torch.empty((k.shape[0], k.shape[1], capacity, k.shape[3]),
+                                    dtype=k.dtype, device=k.device) for _ in range(2)]
+        if self.k is not None:
+            k_buf[:, :, :self.length] = self.k[:, :, :self.length]
+            v_buf[:, :, :self.length] = self.v[:, :, :self.length]
+        self.k, self.v = k_buf, v_buf
+
+    # k, v: (batch_size, num_heads, num_new_steps, head_size)
+    def append(self, k, v):
+        n = k.shape[2]
+        if self.k is None or self.length + n > self.k.shape[2]:
+            self._reserve(k, n)
+        self.k[:, :, self.length:self.length + n] = k
+        self.v[:, :, self.length:self.length + n] = v
+        self.length += n
+        # 返回缓存中全部的键和值: (batch_size, num_heads, length, head_size)
+        return self.k[:, :, :self.length], self.v[:, :, :self.length]
+
+    def index_select(self, index):
+        """沿batch维度挑选或重排缓存，用于束搜索和剔除已经译完的句子"""
+        if self.k is not None:
+            self.k = self.k.index_select(0, index)
+            self.v = self.v.index_select(0, index)
+        return self
 
 class MaskedSoftmaxCELoss(nn.CrossEntropyLoss):
     """带屏蔽的softmax交叉熵损失函数"""
@@ -344,6 +447,8 @@ def train_seq2seq(net, data_iter, lr, num_epochs, tgt_vocab, device):
 def predict_seq2seq(net, src_sentence, src_vocab, tgt_vocab, num_steps, device,
                     save_attention_weights=False):
     net.eval()
+    # 融合的注意力实现不产生注意力权重，需要可视化时才切换到显式计算
+    keep_attention_weights(net, save_attention_weights)
     src_tokens = src_vocab[src_sentence.lower().split(' ')] + [src_vocab['<eos>']]
     enc_valid_len = torch.tensor([len(src_tokens)], device=device)
     src_tokens = truncate_pad(src_tokens, num_steps, src_vocab['<pad>'])
@@ -351,7 +456,7 @@ def predict_seq2seq(net, src_sentence, src_vocab, tgt_vocab, num_steps, device,
     enc_X = torch.unsqueeze(torch.tensor(src_tokens,
                                          dtype=torch.long, device=device), dim=0)
     enc_outputs = net.encoder(enc_X, enc_valid_len)
-    dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
+    dec_state = net.decoder.init_state(enc_outputs, enc_valid_len, num_steps)
     # 添加batch维度
     dec_X = torch.unsqueeze(torch.tensor([tgt_vocab['<bos>']],
                                          dtype=torch.long, device=device), dim=0)
@@ -367,10 +472,162 @@ def predict_seq2seq(net, src_sentence, src_vocab, tgt_vocab, num_steps, device,
         if pred == tgt_vocab['<eos>']:
             break
         output_seq.append(pred)
+    keep_attention_weights(net, False)
     # print('src:', src_sentence, src_vocab[src_sentence.lower().split(' ')])
     # print('target:', output_seq, ' '.join(tgt_vocab.to_tokens(output_seq)))
     return ' '.join(tgt_vocab.to_tokens(output_seq)), attention_weight_seq
 
+# 批量预测
+def _init_dec_state(net, src_sentences, src_vocab, num_steps, device):
+    """把一批源句子按predict_seq2seq的方式填充后运行一次编码器，返回解码器的初始状态"""
+    src_tokens = [src_vocab[sentence.lower().split(' ')] + [src_vocab['<eos>']]
+                  for sentence in src_sentences]
+    enc_valid_len = torch.tensor([min(len(tokens), num_steps) for tokens in src_tokens],
+                                 device=device)
+    # enc_X: (num_sentences, num_steps)
+    enc_X = torch.tensor([truncate_pad(tokens, num_steps, src_vocab['<pad>'])
+                          for tokens in src_tokens], dtype=torch.long, device=device)
+    enc_outputs = net.encoder(enc_X, enc_valid_len)
+    return net.decoder.init_state(enc_outputs, enc_valid_len, num_steps)
+
+def _to_translation(seq, tgt_vocab):
+    """截掉第一个<eos>及其之后的词元"""
+    eos = tgt_vocab['<eos>']
+    if eos in seq:
+        seq = seq[:seq.index(eos)]
+    return ' '.join(tgt_vocab.to_tokens(seq))
+
+def translate_batch(net, src_sentences, src_vocab, tgt_vocab, num_steps, device,
+                    batch_size=256, compact_every=4):
+    """批量贪心解码：每批句子填充后只运行一次编码器，再同步地逐词解码
+
+    已经输出<eos>的句子记在设备上的finished中，解码过程不逐步同步到CPU；
+    每compact_every步检查一次，用decoder.reorder_state把译完的句子从batch中剔除
+    """
+    net.eval()
+    timer = d2l.Timer()
+    eos, translations = tgt_vocab['<eos>'], []
+    with torch.no_grad():
+        for start in range(0, len(src_sentences), batch_size):
+            sentences = src_sentences[start:start + batch_size]
+            num_sentences = len(sentences)
+            dec_state = _init_dec_state(net, sentences, src_vocab, num_steps, device)
+            # dec_X: (num_active, 1)
+            dec_X = torch.full((num_sentences, 1), tgt_vocab['<bos>'], dtype=torch.long, device=device)
+            # rows: 仍在解码的句子在本批中的下标，finished: 这些句子是否已经输出过<eos>
+            rows = torch.arange(num_sentences, device=device)
+            finished = torch.zeros(num_sentences, dtype=torch.bool, device=device)
+            # output_seq: (num_sentences, num_steps)，没有写入的位置保持为<eos>
+            output_seq = torch.full((num_sentences, num_steps), eos, dtype=torch.long, device=device)
+            for step in range(num_steps):
+                Y, dec_state = net.decoder(dec_X, dec_state)
+                # 已经译完但还没被剔除的句子一直输出<eos>
+                dec_X = Y.argmax(dim=2).masked_fill(finished.unsqueeze(1), eos)
+                output_seq[rows, step] = dec_X[:, 0]
+                finished |= dec_X[:, 0] == eos
+                if (step + 1) % compact_every == 0 and step + 1 < num_steps:
+                    # 只在这里同步一次，剔除译完的句子
+                    keep = torch.nonzero(~finished).squeeze(1)
+                    if len(keep) == 0:
+                        break
+                    if len(keep) < len(rows):
+                        rows, finished, dec_X = rows[keep], finished[keep], dec_X[keep]
+                        dec_state = net.decoder.reorder_state(dec_state, keep)
+            translations.extend(_to_translation(seq, tgt_vocab) for seq in output_seq.tolist())
+    print(f'{len(src_sentences) / timer.stop():.1f} sentences/sec on {str(device)}')
+    return translations
+
+def beam_search(net, src_sentences, src_vocab, tgt_vocab, num_steps, device, beam_size=4,
+                alpha=0.75, early_stopping=True, batch_size=64, compact_every=4):
+    """批量束搜索：把batch_size个句子的beam_size个候选合并成batch_size * beam_size行同时解码
+
+    每一步从每个句子的beam_size * vocab_size个扩展中选出得分（对数概率之和）最高的beam_size个，
+    并用decoder.reorder_state按所选候选的来源重排解码器状态。
+    以<eos>结束的候选只能继续接<eos>且得分不变；一个句子的搜索结束时，在已经结束的候选中
+    按score / L^alpha选出最好的候选，L为包括<eos>在内的输出长度，alpha为长度惩罚，
+    到num_steps仍没有候选结束的句子才在所有候选中选择。
+    early_stopping为True时，一个句子得分最高的候选结束后就停止搜索这个句子，
+    否则要等它的所有候选都结束。结果在搜索结束的那一步确定，与compact_every无关
+    """
+    net.eval()
+    timer = d2l.Timer()
+    eos, k, translations, num_tokens = tgt_vocab['<eos>'], beam_size, [], 0
+    with torch.no_grad():
+        for start in range(0, len(src_sentences), batch_size):
+            sentences = src_sentences[start:start + batch_size]
+            num_sentences = len(sentences)
+            dec_state = _init_dec_state(net, sentences, src_vocab, num_steps, device)
+            # 每个句子的状态复制beam_size份，第i个句子的候选位于第i * k到i * k + k - 1行
+            dec_state = net.decoder.reorder_state(
+                dec_state, torch.arange(num_sentences, device=device).repeat_interleave(k))
+            dec_X = torch.full((num_sentences * k, 1), tgt_vocab['<bos>'], dtype=torch.long, device=device)
+            # rows: 仍在搜索的句子在本批中的下标
+            rows = torch.arange(num_sentences, device=device)
+            # scores, lengths, finished: (num_active, k)，一开始只保留每个句子的第一个候选
+            scores = torch.full((num_sentences, k), float('-inf'), device=device)
+            scores[:, 0] = 0
+            lengths = torch.zeros((num_sentences, k), dtype=torch.long, device=device)
+            finished = torch.zeros((num_sentences, k), dtype=torch.bool, device=device)
+            # history: (num_active * k, num_steps)，各候选已经输出的词元
+            history = torch.full((num_sentences * k, num_steps), eos, dtype=torch.long, device=device)
+            # done: (num_active,)，搜索已经结束的句子，它们选出的候选在结束的那一步写入best_seqs
+            done = torch.zeros(num_sentences, dtype=torch.bool, device=device)
+            best_seqs = torch.full((num_sentences, num_steps), eos, dtype=torch.long, device=device)
+            for step in range(num_steps):
+                Y, dec_state = net.decoder(dec_X, dec_state)
+                num_active, vocab_size = scores.shape[0], Y.shape[-1]
+                # log_probs: (num_active, k, vocab_size)
+                log_probs = nn.functional.log_softmax(Y[:, -1], dim=-1).reshape(num_active, k, -1)
+                # 已经结束的候选只能接<eos>，且得分不变
+                eos_only = torch.full((vocab_size,), float('-inf'), device=device)
+                eos_only[eos] = 0
+                log_probs = torch.where(finished.unsqueeze(-1), eos_only, log_probs)
+                # 在每个句子的k * vocab_size个扩展中选得分最高的k个
+                scores, index = (scores.unsqueeze(-1) + log_probs).reshape(num_active, -1).topk(k, dim=1)
+                beam, token = index // vocab_size, index % vocab_size
+                # parent: (num_active * k)，所选候选来自哪一行
+                parent = (torch.arange(num_active, device=device).unsqueeze(1) * k + beam).reshape(-1)
+                prev_finished = finished.reshape(-1)[parent].reshape(num_active, k)
+                lengths = lengths.reshape(-1)[parent].reshape(num_active, k) + (~prev_finished).long()
+                finished = prev_finished | (token == eos)
+                history = history[parent]
+                history[:, step] = token.reshape(-1)
+                dec_X = token.reshape(-1, 1)
+                dec_state = net.decoder.reorder_state(dec_state, parent)
+                last_step = step + 1 == num_steps
+                if last_step:
+                    now_done = torch.ones_like(done)
+                elif early_stopping:
+                    # topk的结果按得分降序排列，第0个候选就是得分最高的候选
+                    now_done = finished[:, 0]
+                else:
+                    now_done = finished.all(dim=1)
+                # 在设备上把这一步结束搜索的句子的最好候选写入best_seqs，不需要同步
+                # 按长度惩罚后的得分只在结束的候选中选择，没有候选结束的句子才在所有候选中选择
+                normalized = scores / lengths.clamp(min=1).float().pow(alpha)
+                candidates = finished | ~finished.any(dim=1, keepdim=True)
+                best = normalized.masked_fill(~candidates, float('-inf')).argmax(dim=1)
+                selected = history.reshape(num_active, k, -1)[torch.arange(num_active, device=device), best]
+                newly_done = (now_done & ~done).unsqueeze(1)
+                best_seqs[rows] = torch.where(newly_done, selected, best_seqs[rows])
+                done = done | now_done
+                if (step + 1) % compact_every == 0 and not last_step:
+                    # 只在这里同步一次，把搜索结束的句子剔除
+                    keep = torch.nonzero(~done).squeeze(1)
+                    if len(keep) == 0:
+                        break
+                    if len(keep) < num_active:
+                        keep_rows = (keep.unsqueeze(1) * k + torch.arange(k, device=device)).reshape(-1)
+                        rows, scores, lengths, finished = rows[keep], scores[keep], lengths[keep], finished[keep]
+                        done, history, dec_X = done[keep], history[keep_rows], dec_X[keep_rows]
+                        dec_state = net.decoder.reorder_state(dec_state, keep_rows)
+            for seq in best_seqs.tolist():
+                translation = _to_translation(seq, tgt_vocab)
+                num_tokens += len(translation.split()) + 1
+                translations.append(translation)
+    print(f'{num_tokens / timer.stop():.1f} tokens/sec on {str(device)}')
+    return translations
+
 # 预测序列的评估
 def bleu(pred_seq, label_seq, k):
     pred_tokens, label_tokens = pred_seq.split(' '), label_seq.split(' ')
@@ -387,6 +644,101 @@ def bleu(pred_seq, label_seq, k):
         score *= math.pow(num_matches / (len_pred - n + 1), math.pow(0.5, n))
     return score
 
+# 语料库级别的BLEU
+def _ngram_keys(tokens, sent_idx, n):
+    """把所有句子中的n元语法排成一个整数矩阵
+
+    tokens: 所有句子拼接起来的词元id，sent_idx: 每个词元所在句子的下标。
+    返回keys: (num_ngrams, n + 1)，每行为(句子下标, 第1个词元id, ..., 第n个词元id)，
+    因此不同句子的相同n元语法互不相同
+    """
+    m = len(tokens) - n + 1
+    if m <= 0:
+        return np.zeros((0, n + 1), dtype=np.int64)
+    # 只保留不跨越句子边界的n元语法
+    valid = sent_idx[:m] == sent_idx[n - 1:]
+    keys = np.stack([sent_idx[:m]] + [tokens[j:j + m] for j in range(n)], axis=1)
+    return keys[valid]
+
+def _row_ids(keys):
+    """把整数矩阵的每一行精确地映射为0到num_ids - 1之间的id，相同的行id相同，返回(ids, num_ids)
+
+    逐列合并：已有的id小于num_ids，与下一列的值合并成id * (max_value + 1) + value，
+    再用np.unique压缩回去，中间结果不超过num_rows * (max_value + 1)，不会溢出或碰撞；
+    对一维整数排序，比np.unique(keys, axis=0)按行比较快得多
+    """
+    ids, num_ids = np.zeros(len(keys), dtype=np.int64), 1
+    for col in keys.T:
+        if len(col) == 0:
+            return ids, 0
+        uniq, ids = np.unique(ids * (col.max() + 1) + col, return_inverse=True)
+        ids, num_ids = ids.reshape(-1), len(uniq)
+    return ids, num_ids
+
+def _bleu_stats(pred_seqs, label_seqs, k):
+    """统计每个句子1到k阶的裁剪匹配数以及预测、标签的长度
+
+    返回matches: (num_seqs, k)，len_pred, len_label: (num_seqs)
+    """
+    # 整个语料库只拼接、切分一次，再把词元映射成整数id
+    pred_tokens, label_tokens = ' '.join(pred_seqs).split(' '), ' '.join(label_seqs).split(' ')
+    token_to_idx = {token: i for i, token in enumerate(set(pred_tokens) | set(label_tokens))}
+    def to_ids(tokens, seqs):
+        lens = np.array([seq.count(' ') + 1 for seq in seqs], dtype=np.int64)
+        # tokens: 所有句子拼接起来的词元id，sent_idx: 每个词元所在句子的下标
+        tokens = np.fromiter(map(token_to_idx.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+        return tokens, np.repeat(np.arange(len(seqs)), lens), lens
+    pred_tokens, pred_sent, len_pred = to_ids(pred_tokens, pred_seqs)
+    label_tokens, label_sent, len_label = to_ids(label_tokens, label_seqs)
+    num_seqs = len(len_pred)
+    matches = np.zeros((num_seqs, k))
+    for n in range(1, k + 1):
+        pred_keys = _ngram_keys(pred_tokens, pred_sent, n)
+        label_keys = _ngram_keys(label_tokens, label_sent, n)
+        # 预测和标签的n元语法一起编号，每个不同的(句子, n元语法)精确地对应一个整数id
+        keys = np.concatenate([pred_keys, label_keys])
+        ids, num_ids = _row_ids(keys)
+        pred_counts = np.bincount(ids[:len(pred_keys)], minlength=num_ids)
+        label_counts = np.bincount(ids[len(pred_keys):], minlength=num_ids)
+        # id_sent: 每个id所在句子的下标
+        id_sent = np.zeros(num_ids, dtype=np.int64)
+        id_sent[ids] = keys[:, 0]
+        # 匹配数裁剪为预测和标签中出现次数的较小值，再按句子累加
+        matches[:, n - 1] = np.bincount(id_sent, weights=np.minimum(pred_counts, label_counts),
+                                        minlength=num_seqs)
+    return matches, len_pred, len_label
+
+def corpus_bleu(pred_seqs, label_seqs, k, num_workers=0):
+    """一次计算整个语料库的BLEU，返回每个句子的得分列表和语料库得分
+
+    句子得分与bleu()相同；语料库得分先把所有句子的匹配数、n元语法数和长度分别求和，
+    再按同样的公式计算。预测的长度小于n时，该阶精度记为0。
+    num_workers大于0时，把语料库分块后在进程池中统计
+    """
+    if len(pred_seqs) == 0:
+        return [], 0.0
+    if num_workers > 0:
+        chunk_size = (len(pred_seqs) + num_workers - 1) // num_workers
+        chunks = [(pred_seqs[i:i + chunk_size], label_seqs[i:i + chunk_size], k)
+                  for i in range(0, len(pred_seqs), chunk_size)]
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.starmap(_bleu_stats, chunks)
+        matches, len_pred, len_label = [np.concatenate(x) for x in zip(*results)]
+    else:
+        matches, len_pred, len_label = _bleu_stats(pred_seqs, label_seqs, k)
+    # totals: (num_seqs, k)，预测中n元语法的个数len_pred - n + 1
+    totals = np.maximum(len_pred[:, None] - np.arange(k), 0)
+    weights = np.power(0.5, np.arange(1, k + 1))
+
+    def score(matches, totals, len_pred, len_label):
+        precisions = np.divide(matches, totals, out=np.zeros_like(matches), where=totals > 0)
+        return (np.exp(np.minimum(0, 1 - len_label / len_pred))
+                * np.prod(np.power(precisions, weights), axis=-1))
+
+    sentence_scores = score(matches, totals, len_pred, len_label)
+    corpus_score = score(matches.sum(0), totals.sum(0), len_pred.sum(), len_label.sum())
+    return sentence_scores.tolist(), float(corpus_score)
+
 # 位置编码
 class PositionalEncoding(nn.Module):
     def __init__(self, num_hiddens, dropout, max_len=1000):
@@ -12,15 +12,22 @@ def transpose_qkv(X, num_heads):
     """为了多注意力头的并行计算而变换形状"""
     # X: (batch_size, num_pair, num_head, num_hiddens / num_head)
     X = X.reshape(X.shape[0], X.shape[1], num_heads, -1)
-    # X: (batch_size, num_head, num_pair, num_hiddens / num_head)
-    X = X.permute(0, 2, 1, 3)
-    # X: (batch_size * num_head, num_pair, num_hiddens / num_head)
-    return X.reshape(-1, X.shape[2], X.shape[3])
-
-# X: (batch_szie * num_head, num_pair, num_hiddens / num_head)
+    # X: (batch_size, num_head, num_pair, num_hiddens / num_head)，只是改变步幅的视图，不拷贝
+    return X.transpose(1, 2)
+
+# X: (batch_size, num_pair, num * num_hiddens)
+def transpose_packed_qkv(X, num, num_heads):
+    """把沿最后一维打包在一起的num个投影一次性变换为多头形状"""
+    batch_size, num_pair = X.shape[0], X.shape[1]
+    # X: (num, batch_size, num_head, num_pair, num_hiddens / num_head)，只是改变步幅的视图，不拷贝
+    X = X.view(batch_size, num_pair, num, num_heads, -1).permute(2, 0, 3, 1, 4)
+    # 每一项: (batch_size, num_head, num_pair, num_hiddens / num_head)
+    return X.unbind(0)
+
+# X: (batch_size, num_head, num_pair, num_hiddens / num_head)
 def transpose_output(X, num_heads):
-    X = X.reshape(-1, num_heads, X.shape[1], X.shape[2])
-    X = X.permute(0, 2, 1, 3)
+    # X: (batch_size, num_pair, num_head, num_hiddens / num_head)
+    X = X.transpose(1, 2)
     # X: (batch_size, num_pair, num_hiddens)
     return X.reshape(X.shape[0], X.shape[1], -1)
 
@@ -30,34 +37,95 @@ class MultiHeadAttention(nn.Module):
                  dropout, bias=False, **kwargs):
         super(MultiHeadAttention, self).__init__(**kwargs)
         self.num_heads = num_heads
+        self.num_hiddens = num_hiddens
         self.attention = common.DotProductAttention(dropout)
-        self.W_q = nn.Linear(query_size, num_hiddens, bias=bias)
-        self.W_k = nn.Linear(key_size, num_hiddens, bias=bias)
-        self.W_v = nn.Linear(value_size, num_hiddens, bias=bias)
+        # 查询、键、值的输入维度相同时，把W_q、W_k、W_v按行拼成一个权重W_qkv，
+        # 自注意力只需一次矩阵乘法；输入维度不同时仍使用三个独立的投影
+        self.fused = query_size == key_size == value_size
+        if self.fused:
+            self.W_qkv = nn.Linear(query_size, 3 * num_hiddens, bias=bias)
+        else:
+            self.W_q = nn.Linear(query_size, num_hiddens, bias=bias)
+            self.W_k = nn.Linear(key_size, num_hiddens, bias=bias)
+            self.W_v = nn.Linear(value_size, num_hiddens, bias=bias)
         self.W_o = nn.Linear(num_hiddens, num_hiddens, bias=bias)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容W_q、W_k、W_v分开保存的参数（如预训练好的BERT），按q、k、v的顺序拼成W_qkv
+        if self.fused:
+            for name in ('weight', 'bias'):
+                keys = [f'{prefix}W_{c}.{name}' for c in 'qkv']
+                if all(key in state_dict for key in keys):
+                    state_dict[f'{prefix}W_qkv.{name}'] = torch.cat(
+                        [state_dict.pop(key) for key in keys], dim=0)
+        super(MultiHeadAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _fused_linear(self, X, start, num):
+        """只用W_qkv中第start个起的num个投影（按q、k、v排列）对X做变换"""
+        h = self.num_hiddens
+        weight, bias = self.W_qkv.weight, self.W_qkv.bias
+        return nn.functional.linear(X, weight[start * h:(start + num) * h],
+                                    None if bias is None else bias[start * h:(start + num) * h])
+
+    # 返回的queries: (batch_size, num_head, query_seq_len, num_hiddens / num_head)
+    def _project_queries(self, queries):
+        if not self.fused:
+            return transpose_qkv(self.W_q(queries), self.num_heads)
+        queries, = transpose_packed_qkv(self._fused_linear(queries, 0, 1), 1, self.num_heads)
+        return queries
+
+    # 返回的keys, values: (batch_size, num_head, key_seq_len, num_hiddens / num_head)
+    def project_kv(self, keys, values):
+        """只投影键和值并拆分成多头，可以把不变的键和值（如编码器输出）投影一次后缓存起来"""
+        if not self.fused:
+            return (transpose_qkv(self.W_k(keys), self.num_heads),
+                    transpose_qkv(self.W_v(values), self.num_heads))
+        if keys is values:
+            # 编码器-解码器注意力：键和值来自同一个张量，一次矩阵乘法得到k、v
+            return transpose_packed_qkv(self._fused_linear(keys, 1, 2), 2, self.num_heads)
+        keys, = transpose_packed_qkv(self._fused_linear(keys, 1, 1), 1, self.num_heads)
+        values, = transpose_packed_qkv(self._fused_linear(values, 2, 1), 1, self.num_heads)
+        return keys, values
+
+    # 返回的queries, keys, values: (batch_size, num_head, num_pair, num_hiddens / num_head)
+    def _project(self, queries, keys, values):
+        if self.fused and queries is keys and keys is values:
+            # 自注意力：一次矩阵乘法同时得到q、k、v
+            return transpose_packed_qkv(self.W_qkv(queries), 3, self.num_heads)
+        return (self._project_queries(queries),) + tuple(self.project_kv(keys, values))
+
     # queries: (batch_size, query_seq_len, query_size)
     # keys: (batch_size, key_seq_len, key_size)
     # values: (batch_size, value_seq_len, value_size)
     # valid_lens: (batch_size) or (batch_size, num_query)
     # key_seq_len = value_seq_len
-    def forward(self, queries, keys, values, valid_lens):
-        # queries: (batch_size * num_head, query_seq_len, num_hiddens / num_head)
-        queries = transpose_qkv(self.W_q(queries), self.num_heads)
-        # keys: (batch_size * num_head, key_seq_len, num_hiddens / num_head)
-        keys = transpose_qkv(self.W_k(keys), self.num_heads)
-        # value: (batch_size * num_head, value_seq_len, num_hiddens / num_head)
-        values = transpose_qkv(self.W_v(values), self.num_heads)
-
-        if valid_lens is not None:
-            # 在轴0，将每一项复制num_heads次
-            valid_lens = torch.repeat_interleave(valid_lens, repeats=self.num_heads, dim=0)
-
-        # output: (batch_num * num_head, query_seq_len, num_hiddens / num_head)
-        output = self.attention(queries, keys, values, valid_lens)
-        # output_concat: (batch_num, query_seq_len, num_hiddens)
+    # cache: 自注意力的common.KVCache，给定时keys、values只包含新的词元
+    # kv: 用project_kv预先投影好的(keys, values)，给定时不再使用keys和values参数
+    def forward(self, queries, keys, values, valid_lens, cache=None, kv=None):
+        # queries: (batch_size, num_head, query_seq_len, num_hiddens / num_head)
+        # keys, values: (batch_size, num_head, key_seq_len, num_hiddens / num_head)
+        if kv is not None:
+            queries, (keys, values) = self._project_queries(queries), kv
+        else:
+            queries, keys, values = self._project(queries, keys, values)
+        if cache is not None:
+            # 只投影了新词元，把它们的键和值写入缓存后，对缓存中的全部位置做注意力
+            # keys, values: (batch_size, num_head, num_cached_steps, num_hiddens / num_head)
+            num_prev = cache.length
+            keys, values = cache.append(keys, values)
+            num_new = queries.shape[2]
+            if valid_lens is None and num_new > 1:
+                # 一次输入多个新词元时，第i个新词元只能看到它自己和它之前的词元
+                valid_lens = torch.arange(num_prev + 1, num_prev + num_new + 1,
+                                          device=queries.device).repeat(queries.shape[0], 1)
+        # 由valid_lens构造一次掩码，在头的维度上广播，不必将valid_lens复制num_heads次
+        # mask: (batch_size, 1, 1, key_seq_len) or (batch_size, 1, num_query, key_seq_len)
+        mask = None if valid_lens is None else common.valid_lens_mask(valid_lens, keys.shape[2]).unsqueeze(1)
+        # output: (batch_size, num_head, query_seq_len, num_hiddens / num_head)
+        output = self.attention(queries, keys, values, mask=mask)
+        # output_concat: (batch_size, query_seq_len, num_hiddens)
         output_concat = transpose_output(output, self.num_heads)
-        # (batch_num, query_seq_len, num_hiddens)
+        # (batch_size, query_seq_len, num_hiddens)
         return self.W_o(output_concat)
 
 num_hiddens, num_heads = 100, 5
@@ -189,36 +257,27 @@ class DecoderBlock(nn.Module):
 
     def forward(self, X, state):
         # X: (batch_num, num_dec_steps, query_size)
-        # enc_outputs: (batch_num, num_enc_steps, num_hiddens)
         # enc_valid_lens: (batch_num)
-        enc_outputs, enc_valid_lens = state[0], state[1]
-        if state[2][self.i] is None:
-            # 训练阶段，输出序列的所有词元都在同一时间处理
-            # state[2][self.i]初始化为None
-            # key_values: (batch_size, num_dec_steps, num_hiddens)
-            key_values = X
-        else:
-            # 预测阶段，输出序列是通过词元一个接着一个解码的，
-            # 因此state[2][self.i]包含着直到当前时间步第i个块解码的输出表示
-            # key_values: (batch_size, num_prev_dec_total + 1, num_hiddens)
-            key_values = torch.cat((state[2][self.i], X), axis=1)
-        state[2][self.i] = key_values
+        enc_valid_lens = state[1]
+        # 自注意力
+        # X2: (batch_num, num_dec_steps, num_hiddens)
         if self.training:
             batch_size, num_steps, _ = X.shape
-            # 训练模式下，把decoder的后续输入mask掉，即每一行长度是[1, 2, .., num_steps]
+            # 训练阶段，输出序列的所有词元都在同一时间处理，
+            # 把decoder的后续输入mask掉，即每一行长度是[1, 2, .., num_steps]
             # dec_valid_lens: (batch_num, num_steps)
             dec_valid_lens = torch.arange(1, num_steps + 1, device=X.device).repeat(batch_size, 1)
+            X2 = self.attention1(X, X, X, dec_valid_lens)
         else:
-            dec_valid_lens = None
-        # 自注意力
-        # X2: (batch_num, num_dec_steps, num_hiddens)
-        # 训练模式下，X(即query)包含完整词元，通过设置dec_valid_lens，让第x个step的query只能看到前x个词元的key_values
-        # 预测模式下，X(即query)仅包含最后一个词元，key_values包含解码器累计到当下的所有词元
-        X2 = self.attention1(X, key_values, key_values, dec_valid_lens)
+            # 预测阶段，输出序列是通过词元一个接着一个解码的，
+            # state[2][self.i]是第i个块的KVCache，保存着之前所有时间步已经投影好的键和值，
+            # 每一步只需投影当前词元，再对缓存中的所有位置做注意力
+            X2 = self.attention1(X, X, X, None, cache=state[2][self.i])
         Y = self.addnorm1(X, X2)
         # 编码器-解码器注意力
+        # 编码器输出的键和值已经在init_state中投影好并保存在state[3][self.i]，每一步直接复用
         # Y2: (batch_num, num_dec_steps, num_hiddens)
-        Y2 = self.attention2(Y, enc_outputs, enc_outputs, enc_valid_lens)
+        Y2 = self.attention2(Y, None, None, enc_valid_lens, kv=state[3][self.i])
         Z = self.addnorm2(Y, Y2)
         return self.addnorm3(Z, self.ffn(Z)), state
 
@@ -227,7 +286,9 @@ decoder_blk = DecoderBlock(24, 24, 24, 24,
                            0.5, 0)
 decoder_blk.eval()
 X = torch.ones((2, 100, 24))
-state = [encoder_blk(X, valid_lens), valid_lens, [None]]
+enc_outputs = encoder_blk(X, valid_lens)
+state = [enc_outputs, valid_lens, [common.KVCache()],
+         [decoder_blk.attention2.project_kv(enc_outputs, enc_outputs)]]
 # (2, 100, 24)
 print(decoder_blk(X, state)[0].shape)
 
@@ -249,8 +310,13 @@ class TransformerDecoder(common.Decoder):
                                               num_heads, dropout, i))
         self.dense = nn.Linear(num_hiddens, vocab_size)
 
-    def init_state(self, enc_outputs, enc_valid_lens, *args):
-        return [enc_outputs, enc_valid_lens, [None] * self.num_layers]
+    # max_steps: 预测时最多解码的步数，用于预先分配每一层的键值缓存
+    def init_state(self, enc_outputs, enc_valid_lens, max_steps=None, *args):
+        # 编码器输出在解码的各个时间步都不变，每一层的编码器-解码器注意力只需投影一次键和值
+        # cross_kv[i]: 两个(batch_size, num_head, num_enc_steps, num_hiddens / num_head)的张量
+        cross_kv = [blk.attention2.project_kv(enc_outputs, enc_outputs) for blk in self.blks]
+        return [enc_outputs, enc_valid_lens,
+                [common.KVCache(max_steps) for _ in range(self.num_layers)], cross_kv]
 
     def forward(self, X, state):
         X = self.pos_encoding(self.embedding(X) * math.sqrt(self.num_hiddens))
@@ -287,11 +353,59 @@ plt.show()
 # 7）预测
 engs = ['go .', "i lost .", 'he\'s calm .', 'i\'m home .']
 fras = ['va !', 'j\'ai perdu .', 'il est calme .', 'je suis chez moi .']
-for eng, fra in zip(engs, fras):
-    translation, dec_attention_weight_seq = common.predict_seq2seq(
-        net, eng, src_vocab, tgt_vocab, num_steps, device, True)
+translations = common.translate_batch(net, engs, src_vocab, tgt_vocab, num_steps, device)
+for eng, fra, translation in zip(engs, fras, translations):
     print(f'{eng} => {translation}, ',
           f'bleu {common.bleu(translation, fra, k=2):.3f}')
+# 束搜索
+translations = common.beam_search(net, engs, src_vocab, tgt_vocab, num_steps, device, beam_size=3)
+for eng, fra, translation in zip(engs, fras, translations):
+    print(f'beam search: {eng} => {translation}, ',
+          f'bleu {common.bleu(translation, fra, k=2):.3f}')
+# 提前停止时只在已经结束的候选中选择：玩具解码器第一步以0.6的概率输出<eos>、0.4的概率输出'a'，之后一直输出'a'
+# 得分最高的候选<eos>结束后就停止搜索，不能返回没有结束的'a a a a'，结果也不随compact_every变化
+class ToyEncoder(common.Encoder):
+    def forward(self, X, *args):
+        return X
+
+class ToyDecoder(common.Decoder):
+    def __init__(self, vocab, **kwargs):
+        super(ToyDecoder, self).__init__(**kwargs)
+        # log_probs[i]: 上一个词元为i时下一个词元的对数概率
+        self.log_probs = torch.full((len(vocab), len(vocab)), -1e9)
+        self.log_probs[:, vocab['a']] = 0
+        self.log_probs[vocab['<bos>'], vocab['<eos>']] = math.log(0.6)
+        self.log_probs[vocab['<bos>'], vocab['a']] = math.log(0.4)
+
+    def init_state(self, enc_outputs, *args):
+        return enc_outputs
+
+    def forward(self, X, state):
+        # X: (batch_size, 1) -> (batch_size, 1, vocab_size)
+        return self.log_probs.to(X.device)[X], state
+
+toy_vocab = common.Vocab(['a'], reserved_tokens=['<pad>', '<bos>', '<eos>'])
+toy_net = common.EncoderDecoder(ToyEncoder(), ToyDecoder(toy_vocab))
+for compact_every in (1, 4):
+    translations = common.beam_search(toy_net, ['a'], toy_vocab, toy_vocab, 10, torch.device('cpu'),
+                                      beam_size=2, compact_every=compact_every)
+    print(f'toy beam search, compact_every={compact_every}: {translations}')
+    assert translations == ['']
+# 在整个数据集上批量翻译，一次算出每个句子和整个语料库的BLEU
+source, target = common.tokenize_nmt(common.preprocess_nmt(common.read_data_nmt()), 600)
+translations = common.translate_batch(net, [' '.join(line) for line in source],
+                                      src_vocab, tgt_vocab, num_steps, device)
+labels = [' '.join(line) for line in target]
+sentence_scores, corpus_score = common.corpus_bleu(translations, labels, k=2)
+print(f'corpus bleu {corpus_score:.3f}, '
+      f'mean sentence bleu {sum(sentence_scores) / len(sentence_scores):.3f}')
+# 每个句子的得分与bleu()一致，bleu()要求预测至少有k个词元
+for translation, label, score in zip(translations, labels, sentence_scores):
+    if len(translation.split(' ')) >= 2:
+        assert math.isclose(score, common.bleu(translation, label, k=2), abs_tol=1e-9)
+# 可视化注意力权重时仍逐句预测
+translation, dec_attention_weight_seq = common.predict_seq2seq(
+    net, engs[-1], src_vocab, tgt_vocab, num_steps, device, True)
 
 enc_attention_weights = (torch.cat(net.encoder.attention_weights, 0)
                          .reshape((num_layers, num_heads, -1, num_steps)))
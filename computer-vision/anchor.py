@@ -1,6 +1,7 @@
 import common
 import torch
 import matplotlib.pyplot as plt
+from d2l import torch as d2l
 
 torch.set_printoptions(2)
 
@@ -264,3 +265,29 @@ for i in output[0].detach().numpy():
     label = ('dog=', 'cat=')[int(i[0])] + str(i[1])
     show_bboxes(fig.axes, [torch.tensor(i[2:]) * bbox_scale], label)
 plt.show()
+
+# 批量实现：批量nms和批量标注锚框的结果与上面逐个处理的实现相同
+boxes = offset_inverse(anchors, offset_preds.reshape(-1, 4))
+scores = cls_probs[1:].max(dim=0)[0]
+order, keep_mask = common.batched_nms(boxes.unsqueeze(0), scores.unsqueeze(0), iou_threshold=0.5)
+assert torch.equal(order[0][keep_mask[0]], nms(boxes, scores, 0.5))
+batch_size, num_gt = 32, 4
+batch_anchors = multibox_prior(torch.rand(size=(1, 3, 32, 32)), sizes=[0.75, 0.5, 0.25], ratios=[1, 2, 0.5])
+xy = torch.rand(batch_size, num_gt, 2) * 0.6
+labels = torch.cat((torch.randint(0, 2, (batch_size, num_gt, 1)).float(),
+                    xy, xy + torch.rand(batch_size, num_gt, 2) * 0.4), dim=2)
+assert all(torch.equal(a, b) for a, b in zip(multibox_target(batch_anchors, labels),
+                                             common.multibox_target(batch_anchors, labels)))
+# 大量几乎重合的框：置信度最高的框抑制其余所有框，批量nms的结果应该只剩这一个框
+boxes = torch.tensor([0.1, 0.1, 0.5, 0.5]) + torch.rand(200, 4) * 1e-3
+scores = torch.rand(200)
+order, keep_mask = common.batched_nms(boxes.repeat(4, 1, 1), scores.repeat(4, 1), iou_threshold=0.5)
+assert keep_mask.sum(dim=1).tolist() == [1] * 4 and (order[keep_mask] == scores.argmax()).all()
+
+# 分块计算交并比：为整张图片上的全部锚框匹配真实边界框，不生成完整的交并比中间张量
+print('tiled box_iou')
+all_anchors = Y.squeeze(0)
+max_ious, indices = common.box_iou_max(all_anchors, ground_truth[:, 1:], memory_budget=2 ** 24)
+print(all_anchors.shape, max_ious.shape, (max_ious >= 0.5).sum(), indices[max_ious >= 0.5].bincount())
+sparse_iou = common.box_iou_sparse(all_anchors, ground_truth[:, 1:], threshold=0.5, memory_budget=2 ** 24)
+print(sparse_iou._nnz(), 'pairs with iou >= 0.5')
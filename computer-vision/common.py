@@ -1,5 +1,12 @@
+import collections
+import hashlib
+import math
 import matplotlib.pyplot as plt
+import numpy as np
+import os
+import pandas as pd
 import torch
+import torchvision
 from torch import nn
 from torch.nn import functional as F
 from d2l import torch as d2l
@@ -150,9 +157,101 @@ def train_ch13(net, train_iter, test_iter, loss, trainer, num_epochs, devices=tr
               f'test acc {test_acc:.3f}')
         print(f'{metric[2] * num_epochs / timer.sum():.1f} examples/sec on {str(devices)}')
 
+# 目标检测数据集
+d2l.DATA_HUB['banana-detection'] = (d2l.DATA_URL + 'banana-detection.zip',
+                                    '5de26c8fce5ccdea9f91267273464dc968d20d72')
+
+def _bananas_hash(data_dir, path):
+    """根据标注文件以及所有图片的文件名和内容计算数据集的哈希，用于判断缓存是否失效"""
+    sha1 = hashlib.sha1()
+    with open(os.path.join(data_dir, path, 'label.csv'), 'rb') as f:
+        sha1.update(f.read())
+    img_dir = os.path.join(data_dir, path, 'images')
+    for img_name in sorted(os.listdir(img_dir)):
+        sha1.update(img_name.encode())
+        with open(os.path.join(img_dir, img_name), 'rb') as f:
+            sha1.update(f.read())
+    return sha1.hexdigest()
+
+def cache_data_bananas(is_train=True):
+    """把香蕉检测数据集一次性解码成打包的uint8图片数组和标签数组，保存为.npy文件
+    缓存目录中的hash文件记录生成缓存时数据集的哈希，数据集变化后重新生成；返回缓存目录"""
+    data_dir = d2l.download_extract('banana-detection')
+    path = 'bananas_train' if is_train else 'bananas_val'
+    cache_dir = os.path.join(data_dir, f'{path}_cache')
+    hash_fname = os.path.join(cache_dir, 'hash')
+    data_hash = _bananas_hash(data_dir, path)
+    if os.path.exists(hash_fname):
+        with open(hash_fname, 'r') as f:
+            if f.read() == data_hash:
+                return cache_dir
+        # 先删除哈希文件，生成缓存的过程中被打断时不会误用不完整的缓存
+        os.remove(hash_fname)
+    os.makedirs(cache_dir, exist_ok=True)
+    csv_data = pd.read_csv(os.path.join(data_dir, path, 'label.csv'))
+    img_names = csv_data['img_name'].tolist()
+    read_image = lambda img_name: torchvision.io.read_image(
+        os.path.join(data_dir, path, 'images', img_name)).numpy()
+    first_image = read_image(img_names[0])
+    # images: (num_images, channel, height, width)，直接写入.npy文件，不在内存中保留所有图片
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(len(img_names), *first_image.shape))
+    images[0] = first_image
+    for i, img_name in enumerate(img_names[1:], start=1):
+        images[i] = read_image(img_name)
+    images.flush()
+    del images
+    # 这里的target包含（类别，左上角x，左上角y，右下角x，右下角y），
+    # 256是图像的长和宽，目标边框的取值归一化到[0,1]
+    # labels: (num_images, 1, 5)
+    targets = csv_data.drop(columns='img_name').to_numpy(dtype=np.float32)
+    np.save(os.path.join(cache_dir, 'labels.npy'), (targets / 256)[:, None, :])
+    with open(hash_fname, 'w') as f:
+        f.write(data_hash)
+    return cache_dir
+
+class BananasDataset(torch.utils.data.Dataset):
+    """从缓存读取香蕉检测数据集
+    图片以内存映射的方式打开，按uint8零拷贝返回，在整个批量上再转换为浮点数"""
+    def __init__(self, is_train):
+        cache_dir = cache_data_bananas(is_train)
+        self.images_fname = os.path.join(cache_dir, 'images.npy')
+        self.labels = torch.from_numpy(np.load(os.path.join(cache_dir, 'labels.npy')))
+        # 在每个进程(包括DataLoader的worker)中第一次读取时才打开内存映射，避免序列化时复制整个数组
+        self._features = None
+        print('read ' + str(len(self.labels)) +
+              (f' training examples' if is_train else f' validation examples'))
+
+    @property
+    def features(self):
+        if self._features is None:
+            # mode='c'为写时复制，取出的数组可写，可以零拷贝地转换成张量
+            self._features = np.load(self.images_fname, mmap_mode='c')
+        return self._features
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+    def __getitem__(self, idx):
+        # ((channel, height, width) uint8, (1, 5))
+        return (torch.from_numpy(self.features[idx]), self.labels[idx])
+
+    def __len__(self):
+        return len(self.labels)
+
+def load_data_bananas(batch_size):
+    """加载香蕉检测数据集，图片为uint8，使用前需要在批量上调用.float()"""
+    train_iter = torch.utils.data.DataLoader(BananasDataset(is_train=True),
+                                             batch_size=batch_size, shuffle=True)
+    test_iter = torch.utils.data.DataLoader(BananasDataset(is_train=False),
+                                            batch_size=batch_size)
+    return train_iter, test_iter
+
 # 边界框
 def box_corner_to_center(boxes):
-    x1, y1, x2, y2 = boxes[:, 0], boxes[:,  1], boxes[:, 2], boxes[:, 3]
+    x1, y1, x2, y2 = boxes[..., 0], boxes[...,  1], boxes[..., 2], boxes[..., 3]
     cx = (x1 + x2) / 2
     cy = (y1 + y2) / 2
     w = x2 - x1
@@ -161,7 +260,7 @@ def box_corner_to_center(boxes):
     return boxes
 
 def box_center_to_corner(boxes):
-    cx, cy, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    cx, cy, w, h = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
     x1 = cx - 0.5 * w
     y1 = cy - 0.5 * h
     x2 = cx + 0.5 * w
@@ -222,29 +321,105 @@ def multibox_prior(data, sizes, ratios):
     # (1, (in_height * in_width) * (num_sizes + num_ratios - 1), 4)
     return output.unsqueeze(0)
 
+class AnchorGenerator:
+    """带LRU缓存的锚框生成器
+    锚框只和特征图的高宽、sizes、ratios以及设备、数据类型有关，与特征图的取值无关，
+    因此以(h, w, sizes, ratios, device, dtype)为键缓存multibox_prior的结果，同一形状只计算一次。
+    返回的锚框在多次调用间共享，调用方不能原地修改"""
+    def __init__(self, max_cache_size=64):
+        self.max_cache_size = max_cache_size
+        self._cache = collections.OrderedDict()
+
+    def __call__(self, data, sizes, ratios):
+        # data: (batch_size, channels, in_height, in_width)
+        in_height, in_width = data.shape[-2:]
+        return self.get(in_height, in_width, sizes, ratios, data.device, data.dtype)
+
+    def get(self, in_height, in_width, sizes, ratios, device=None, dtype=torch.float32):
+        key = (in_height, in_width, tuple(sizes), tuple(ratios), torch.device(device or 'cpu'), dtype)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        # multibox_prior只用到data的形状和设备，用一个不含元素的张量代替特征图
+        data = torch.empty((1, 0, in_height, in_width), device=device)
+        anchors = multibox_prior(data, sizes, ratios).to(dtype)
+        self._cache[key] = anchors
+        if len(self._cache) > self.max_cache_size:
+            # 淘汰最久没有用到的锚框
+            self._cache.popitem(last=False)
+        return anchors
+
+    def precompute(self, feature_shapes, sizes, ratios, device=None, dtype=torch.float32):
+        """为一组固定的特征图形状提前计算拼接好的锚框
+        feature_shapes: [(in_height, in_width)]，与sizes、ratios一一对应
+        返回 (1, sum(in_height * in_width * boxes_per_pixel), 4)"""
+        return torch.cat([self.get(h, w, size, ratio, device, dtype)
+                          for (h, w), size, ratio in zip(feature_shapes, sizes, ratios)], dim=1)
+
 def offset_boxes(anchors, assigned_bb, eps=1e-6):
     """对锚框偏移量的转换"""
     c_anc = box_corner_to_center(anchors)
     c_assigned_bb = box_corner_to_center(assigned_bb)
-    offset_xy = 10 * (c_assigned_bb[:, :2] - c_anc[:, :2]) / c_anc[:, 2:]
-    offset_wd = 5 * torch.log(eps + c_assigned_bb[:, 2:] / c_anc[:, 2:])
-    offset = torch.cat([offset_xy, offset_wd], axis=1)
+    # anchors: (num_anchors, 4)
+    # assigned_bb: (..., num_anchors, 4)，前面的批量维度与anchors进行广播
+    offset_xy = 10 * (c_assigned_bb[..., :2] - c_anc[..., :2]) / c_anc[..., 2:]
+    offset_wd = 5 * torch.log(eps + c_assigned_bb[..., 2:] / c_anc[..., 2:])
+    offset = torch.cat([offset_xy, offset_wd], axis=-1)
     return offset
 
 # 并交比
 def box_iou(boxes1, boxes2):
-    """计算两个锚框或边界框列表中成对的交并比"""
-    box_area = lambda boxes:((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))
+    """计算两个锚框或边界框列表中成对的交并比
+    boxes1: (..., m, 4), boxes2: (..., n, 4), 前面的批量维度会进行广播，返回 (..., m, n)"""
+    box_area = lambda boxes:((boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1]))
     areas1 = box_area(boxes1)
     areas2 = box_area(boxes2)
-    # inter_upperlefts维度（m, n, 2)。max在boxes1(m, 1, 2)和boxes2(n, 2)的最后一个维度上进行比较
-    inter_upperlefts = torch.max(boxes1[:, None, :2], boxes2[:, :2])
-    inter_lowerrights = torch.min(boxes1[:, None, 2:], boxes2[:, 2:])
-    inters = (inter_lowerrights - inter_upperlefts).clamp(min=0)
-    inter_areas = inters[:, :, 0] * inters[:, :, 1]
-    union_areas = areas1[:, None] + areas2 - inter_areas
+    # 分别在x轴和y轴上求交集的边长，避免生成(m, n, 2)的中间张量
+    # inter_w, inter_h维度（m, n)。max/min在boxes1(m, 1)和boxes2(1, n)之间广播进行比较
+    inter_w = (torch.min(boxes1[..., :, None, 2], boxes2[..., None, :, 2])
+               - torch.max(boxes1[..., :, None, 0], boxes2[..., None, :, 0])).clamp(min=0)
+    inter_h = (torch.min(boxes1[..., :, None, 3], boxes2[..., None, :, 3])
+               - torch.max(boxes1[..., :, None, 1], boxes2[..., None, :, 1])).clamp(min=0)
+    inter_areas = inter_w * inter_h
+    union_areas = areas1[..., :, None] + areas2[..., None, :] - inter_areas
     return inter_areas / union_areas
 
+def _box_iou_chunks(boxes1, boxes2, memory_budget):
+    """按内存预算把boxes1沿行切块，依次返回(起始行号, 该块与boxes2的交并比)"""
+    batch_shape = torch.broadcast_shapes(boxes1.shape[:-2], boxes2.shape[:-2])
+    # 每一行交并比在计算过程中约有4个(batch, n)大小的中间张量
+    row_bytes = 4 * math.prod(batch_shape) * boxes2.shape[-2] * boxes2.element_size()
+    chunk_size = max(1, memory_budget // max(1, row_bytes))
+    for start in range(0, max(1, boxes1.shape[-2]), chunk_size):
+        yield start, box_iou(boxes1[..., start:start + chunk_size, :], boxes2)
+
+def box_iou_tiled(boxes1, boxes2, memory_budget=2 ** 28):
+    """分块计算交并比，中间张量的内存不超过memory_budget字节，结果与box_iou完全一致"""
+    return torch.cat([iou for _, iou in _box_iou_chunks(boxes1, boxes2, memory_budget)], dim=-2)
+
+def box_iou_max(boxes1, boxes2, memory_budget=2 ** 28):
+    """分块计算交并比并直接在块内求每一行的最大值及其索引，不生成完整的(m, n)交并比矩阵
+    返回 max_ious: (..., m), indices: (..., m)，与torch.max(box_iou(boxes1, boxes2), dim=-1)一致"""
+    max_ious, indices = [], []
+    for _, iou in _box_iou_chunks(boxes1, boxes2, memory_budget):
+        chunk_max, chunk_idx = torch.max(iou, dim=-1)
+        max_ious.append(chunk_max)
+        indices.append(chunk_idx)
+    return torch.cat(max_ious, dim=-1), torch.cat(indices, dim=-1)
+
+def box_iou_sparse(boxes1, boxes2, threshold, memory_budget=2 ** 28):
+    """分块计算交并比，只保留大于等于threshold的框对，返回稀疏(COO)张量，形状与box_iou的结果相同"""
+    indices, values = [], []
+    for start, iou in _box_iou_chunks(boxes1, boxes2, memory_budget):
+        mask = iou >= threshold
+        idx = torch.nonzero(mask)
+        # 块内的行号加上块的起始行号，得到在boxes1中的行号
+        idx[:, -2] += start
+        indices.append(idx)
+        values.append(iou[mask])
+    size = torch.broadcast_shapes(boxes1.shape[:-2], boxes2.shape[:-2]) + (boxes1.shape[-2], boxes2.shape[-2])
+    return torch.sparse_coo_tensor(torch.cat(indices).T, torch.cat(values), size, check_invariants=False)
+
 # 在训练中标注锚框
 def assign_anchor_to_bbox(ground_truth, anchors, device, iou_threshold=0.5):
     """将最接近的真实边界框(gt bbox)分配给锚框(anchor)
@@ -273,50 +448,82 @@ def assign_anchor_to_bbox(ground_truth, anchors, device, iou_threshold=0.5):
         jaccard[anc_idx, :] = row_discard
     return anchors_bbox_map
 
+def batch_assign_anchor_to_bbox(ground_truth, anchors, valid_mask=None, iou_threshold=0.5,
+                                memory_budget=2 ** 28):
+    """一次为整个批量的锚框分配真实边界框
+    与assign_anchor_to_bbox的规则相同，但真实边界框按批量填充成(batch_size, num_gt_boxes, 4)，
+    由valid_mask标记哪些是有效的真实边界框；“每个真实边界框至少分配一个锚框”的贪心匹配
+    通过num_gt_boxes轮带掩码的argmax完成，每一轮同时处理批量中所有的图片"""
+    # ground_truth: (batch_size, num_gt_boxes, 4)
+    # anchors: (num_anchors, 4)
+    # valid_mask: (batch_size, num_gt_boxes)
+    batch_size, num_gt_boxes = ground_truth.shape[:2]
+    num_anchors, device = anchors.shape[0], anchors.device
+    # jaccard: (batch_size, num_anchors, num_gt_boxes)
+    # 锚框很多时分块计算，避免交并比的中间张量占用过多内存
+    jaccard = box_iou_tiled(anchors, ground_truth, memory_budget)
+    if valid_mask is not None:
+        # 填充的真实边界框的交并比置为-1，既不会满足阈值，也不会在贪心匹配中被选中
+        jaccard = jaccard.masked_fill(~valid_mask.unsqueeze(1), -1)
+    # 对交并比大于等于阈值的锚框(anchor)分配对应的真实边界框(bbox)
+    max_ious, indices = torch.max(jaccard, dim=2)
+    anchors_bbox_map = torch.where(max_ious >= iou_threshold, indices, -1)
+    # 无视阈值，让每一个真实边界框，都能分配到一个合适的锚框
+    batch_idx = torch.arange(batch_size, device=device)
+    for _ in range(num_gt_boxes):
+        # 每张图片在剩余的(锚框, 真实边界框)中找交并比最大的一对
+        max_val, max_idx = torch.max(jaccard.reshape(batch_size, -1), dim=1)
+        box_idx = max_idx % num_gt_boxes
+        anc_idx = torch.div(max_idx, num_gt_boxes, rounding_mode='floor')
+        # 有效的真实边界框已经全部分配完的图片，最大值为-1，本轮不再修改
+        matched = max_val >= 0
+        anchors_bbox_map[batch_idx, anc_idx] = torch.where(
+            matched, box_idx, anchors_bbox_map[batch_idx, anc_idx])
+        jaccard[batch_idx, :, box_idx] = -1
+        jaccard[batch_idx, anc_idx, :] = -1
+    # (batch_size, num_anchors)
+    return anchors_bbox_map
+
 def multibox_target(anchors, labels):
     """使用真实边界框标记锚框
-    按批次遍历标签数据，针对每个批次内的样本，先将真实边界框分配给锚框得到映射关系，
-    基于此生成用于标记参与计算的锚框的初始化类别标签，已分配边界框坐标和掩码，
+    整个批量一起计算：先将真实边界框分配给锚框得到映射关系，
+    基于此生成用于标记参与计算的锚框的类别标签，已分配边界框坐标和掩码，
     再根据已分配边界框坐标和掩码，计算锚框的偏移量，
-    最后为每个锚框，返回每个批次的偏移量、掩码和类别标签分别堆叠成张量返回
+    最后返回整个批量的偏移量、掩码和类别标签
+    labels中类别小于0的行视为填充的真实边界框
     """
     # anchors: (1, num_anchors, 4)
     # labels: (batch_size, num_labels, 5)
     batch_size, anchors = labels.shape[0], anchors.squeeze(0)
-    batch_offset, batch_mask, batch_class_labels = [], [], []
-    device, num_anchors = anchors.device, anchors.shape[0]
-    for i in range(batch_size):
-        label = labels[i, :, :]
-        # 初始化anchor的分类和边界框
-        class_labels = torch.zeros(num_anchors, dtype=torch.long, device=device)
-        assigned_bb = torch.zeros((num_anchors, 4), dtype=torch.float32, device=device)
-        # 获得每一个anchor的label索引编号（-1为无分类）
-        anchors_bbox_map = assign_anchor_to_bbox(label[:, 1:], anchors, device)
-        # 计算anchor的分类，边界框，掩码和偏移
-        indices_true = torch.nonzero(anchors_bbox_map >= 0) # 生成一个二维向量，用来做为索引，形如：[[1],[3],[4],...]
-        bb_idx = anchors_bbox_map[indices_true] # bb_idx维度与indices_true一致，形如:[[12],[7],[6]...]
-        class_labels[indices_true] = label[bb_idx, 0].long() + 1 # anchor的分类
-        assigned_bb[indices_true] = label[bb_idx, 1:] # anchor的边界框
-        bbox_mask = ((anchors_bbox_map >= 0).float().unsqueeze(-1)).repeat(1, 4) # anchor的掩码
-        offset = offset_boxes(anchors, assigned_bb) * bbox_mask # anchor的偏移
-        batch_class_labels.append(class_labels)
-        batch_mask.append(bbox_mask.reshape(-1))
-        batch_offset.append(offset.reshape(-1))
+    num_anchors = anchors.shape[0]
+    # 获得每一个anchor的label索引编号（-1为无分类）
+    # anchors_bbox_map: (batch_size, num_anchors)
+    anchors_bbox_map = batch_assign_anchor_to_bbox(labels[:, :, 1:], anchors, labels[:, :, 0] >= 0)
+    assigned = anchors_bbox_map >= 0
+    # 按映射关系取出每一个anchor对应的label，未分配的anchor先取第0个，之后再用掩码清零
+    # assigned_label: (batch_size, num_anchors, 5)
+    assigned_label = torch.gather(labels, 1, anchors_bbox_map.clamp(min=0).unsqueeze(-1).expand(-1, -1, 5))
+    # 计算anchor的分类，边界框，掩码和偏移
+    class_labels = torch.where(assigned, assigned_label[:, :, 0].long() + 1, 0) # anchor的分类
+    assigned_bb = assigned_label[:, :, 1:] * assigned.unsqueeze(-1) # anchor的边界框
+    bbox_mask = assigned.float().unsqueeze(-1).repeat(1, 1, 4) # anchor的掩码
+    offset = offset_boxes(anchors, assigned_bb) * bbox_mask # anchor的偏移
     # (batch_size, total_num_anchor)
-    class_labels = torch.stack(batch_class_labels)
     # (batch_size, total_num_anchor * 4)
-    bbox_mask = torch.stack(batch_mask)
     # (batch_size, total_num_anchor * 4)
-    bbox_offset = torch.stack(batch_offset)
+    bbox_offset = offset.reshape(batch_size, -1)
+    bbox_mask = bbox_mask.reshape(batch_size, -1)
     return(bbox_offset, bbox_mask, class_labels)
 
 def offset_inverse(anchors, offset_preds):
     """根据带有预测偏移量的锚框来预测边界框"""
     # 下面用到的5、1、exp，与offset_boxes函数保持一致
+    # anchors: (num_anchors, 4)
+    # offset_preds: (..., num_anchors, 4)，前面的批量维度与anchors进行广播
     anc = box_corner_to_center(anchors)
-    pred_bbox_xy = (offset_preds[:, :2] * anc[:, 2:] / 10) + anc[:, :2]
-    pred_bbox_wh = torch.exp(offset_preds[:, 2:] / 5) * anc[:, 2:]
-    pred_box = torch.cat((pred_bbox_xy, pred_bbox_wh), axis=1)
+    pred_bbox_xy = (offset_preds[..., :2] * anc[..., 2:] / 10) + anc[..., :2]
+    pred_bbox_wh = torch.exp(offset_preds[..., 2:] / 5) * anc[..., 2:]
+    pred_box = torch.cat((pred_bbox_xy, pred_bbox_wh), axis=-1)
     predicated_box = box_center_to_corner(pred_box)
     return predicated_box
 
@@ -325,67 +532,373 @@ def nms(boxes, scores, iou_threshold):
     依据设定的交并比阈值筛选掉那些与高置信度框重叠度过高的低置信度框"""
     # boxes: (num_boxes, 4)
     # scores: (num_boxes)
-    original_device = boxes.device
-    # nms计算在某些gpu(比如mps上）特别慢，拷贝到cpu上进行运算
-    if (original_device != torch.device("cpu")):
-        boxes = boxes.to('cpu')
-        scores = scores.to('cpu')
-    B = torch.argsort(scores, dim=-1, descending=True)
-    keep = []
-    while B.numel() > 0:
-        i = B[0]
-        keep.append(i)
-        if B.numel() == 1: break
-        iou = box_iou(boxes[i, :].reshape(-1, 4), boxes[B[1:], :].reshape(-1, 4)).reshape(-1)
-        inds = torch.nonzero(iou <= iou_threshold). reshape(-1) # 保留交并比小于等于阈值的框对应的索引（去除重叠度高的）
-        B = B[inds + 1] # inds + 1 是因为前面在计算交并比时去掉了当前置信度最高的框（索引为 0）
-    return torch.tensor(keep, device=original_device)
-
-def multibox_detection(cls_probs, offset_preds, anchors, nms_threshold=0.5, pos_threshold=0.009999999):
+    # 单张图片的nms即batch_size为1的批量nms
+    order, keep_mask = batched_nms(boxes.unsqueeze(0), scores.unsqueeze(0), iou_threshold)
+    # keep: (num_keep), 按照置信度从高到低排列的保留框索引
+    return order[0][keep_mask[0]]
+
+def _nms_round(sorted_boxes, areas, alive, cols, keep_mask, batch_idx, iou_threshold):
+    """batched_nms的一轮：每张图片保留第一个未被抑制的框，并抑制与它重叠过高的框，原地修改alive和keep_mask"""
+    # top: (batch_size,), 每张图片中第一个未被抑制的框，已经处理完的图片得到的top无效
+    top = alive.to(torch.uint8).argmax(dim=1)
+    keep_mask[batch_idx, cols[top]] |= alive[batch_idx, top]
+    # iou: (batch_size, num_cols), 保留的框与同一图片中剩余的框的交并比，计算方式与box_iou相同
+    top_boxes = sorted_boxes[batch_idx, top].unsqueeze(1)
+    inter_w = (torch.min(top_boxes[..., 2], sorted_boxes[..., 2])
+               - torch.max(top_boxes[..., 0], sorted_boxes[..., 0])).clamp(min=0)
+    inter_h = (torch.min(top_boxes[..., 3], sorted_boxes[..., 3])
+               - torch.max(top_boxes[..., 1], sorted_boxes[..., 1])).clamp(min=0)
+    inter_areas = inter_w * inter_h
+    iou = inter_areas / (areas[batch_idx, top].unsqueeze(1) + areas - inter_areas)
+    # 保留交并比小于等于阈值的框（去除重叠度高的），保留的框本身也不再参与后面的轮次
+    alive &= iou <= iou_threshold
+    alive[batch_idx, top] = False
+
+def batched_nms(boxes, scores, iou_threshold, class_ids=None, max_sync_every=64):
+    """批量非极大值抑制
+    一次处理整个批量的所有框：按置信度排序后，每一轮同时从每张图片中取出排在最前面且未被抑制的框保留下来，
+    再用一次批量的交并比计算抑制各图片中与它重叠过高的框。循环的轮数等于单张图片保留框数的最大值，而不是框的总数，
+    全部计算都在输入所在的设备上进行，保留结果与逐个弹出框的nms完全一致（交并比大于阈值的框被抑制）
+    没有采用先算出整个交并比位掩码再扫描的做法：位掩码需要计算所有num_boxes * num_boxes对框的交并比，
+    5444个锚框、批量32时约9.5亿对，而按保留的框逐轮抑制只需计算保留框数 * num_boxes对。
+    轮数取决于数据，为了减少同步，两次同步之间的轮数从8开始翻倍，最多为max_sync_every轮，
+    图片处理完之后多跑的轮次不改变结果"""
+    # boxes: (batch_size, num_boxes, 4)
+    # scores: (batch_size, num_boxes)
+    # class_ids: (batch_size, num_boxes)，为None时不区分类别
+    batch_size, num_boxes = scores.shape
+    device = boxes.device
+    if class_ids is not None:
+        # 给不同类别的框加上不同的坐标偏移，使不同类别的框之间交并比为0，从而只在同类之间做抑制
+        offsets = class_ids.to(boxes.dtype) * (boxes.max() + 1)
+        boxes = boxes + offsets.unsqueeze(-1)
+    # order: (batch_size, num_boxes), 按置信度从高到低排序的框索引
+    order = torch.argsort(scores, dim=-1, descending=True)
+    # sorted_boxes: (batch_size, num_boxes, 4)
+    sorted_boxes = torch.gather(boxes, 1, order.unsqueeze(-1).expand(-1, -1, 4))
+    # areas: (batch_size, num_boxes), 面积只需计算一次
+    areas = (sorted_boxes[..., 2] - sorted_boxes[..., 0]) * (sorted_boxes[..., 3] - sorted_boxes[..., 1])
+    batch_idx = torch.arange(batch_size, device=device)
+    # alive: (batch_size, num_cols), 排序后的框既未被保留也未被抑制
+    # cols: (num_cols,), alive、sorted_boxes和areas的每一列对应的排序位置
+    alive = torch.ones((batch_size, num_boxes), dtype=torch.bool, device=device)
+    cols = torch.arange(num_boxes, device=device)
+    keep_mask = torch.zeros((batch_size, num_boxes), dtype=torch.bool, device=device)
+    sync_every = 8
+    while True:
+        # 只在这里同步一次
+        live = alive.any(dim=0)
+        num_live = int(live.sum())
+        if num_live == 0:
+            break
+        # 所有图片中都已失效的列不再参与计算，失效过半时压缩一次
+        if num_live * 2 <= len(cols):
+            live_cols = torch.nonzero(live).squeeze(1)
+            alive, cols = alive[:, live_cols], cols[live_cols]
+            sorted_boxes, areas = sorted_boxes[:, live_cols], areas[:, live_cols]
+        for _ in range(sync_every):
+            _nms_round(sorted_boxes, areas, alive, cols, keep_mask, batch_idx, iou_threshold)
+        sync_every = min(sync_every * 2, max_sync_every)
+    # order: (batch_size, num_boxes)
+    # keep_mask: (batch_size, num_boxes), order中对应位置的框是否被保留
+    return order, keep_mask
+
+def multibox_detection(cls_probs, offset_preds, anchors, nms_threshold=0.5, pos_threshold=0.009999999,
+                       top_k=None):
     """使用非极大值抑制来预测边界框
     根据分类预测的结找出每个anchor的最大置信度的预测值和分类索引，
     利用nms筛选出有分类的anchor索引，并将未筛选出的anchor分类设置为背景类
     将预估分低于阈值的anchor分类设为背景类，并修改对应的置信度值
-    最后拼接获得anchor的分类、置信度和边界框信息列表"""
+    最后拼接获得anchor的分类、置信度和边界框信息列表
+    整个批量一起解码和做nms，没有逐图片的循环；
+    指定top_k时只返回排在最前面的top_k行，不再生成所有背景类的行"""
     # cls_probs: (batch_size, num_class, num_anchor)
-    # offset_preds: (batch_size, num_anchors, 4)
+    # offset_preds: (batch_size, num_anchors * 4)
     # anchors: (1, num_anchors, 4)
     device, batch_size = cls_probs.device, cls_probs.shape[0]
     # batch中每一个图片的anchors应该是一样的，anchors的第一维度应该是无效的0
     # anchors: (num_anchors, 4)
     anchors = anchors.squeeze(0)
     num_class, num_anchors = cls_probs.shape[1], cls_probs.shape[2]
-    out = []
-    for i in range(batch_size):
-        # cls_prob: (num_class，num_anchor)
-        # offset_pred: (num_anchor, 4)
-        cls_prob, offset_pred = cls_probs[i], offset_preds[i].reshape(-1, 4)
-        # 去除第一个背景类，得到每一个anchor概率最大的类别
-        # conf: (num_anchor)
-        # class_id: (num_anchor)
-        conf, class_id = torch.max(cls_prob[1:], 0)
-        # predicted_bb: (num_anchor, 4)
-        predicted_bb = offset_inverse(anchors, offset_pred)
-        # keep: (num_index), 按照conf的分数从高到低排序给出位置索引，并且去除了iou重复度高的
-        keep = nms(predicted_bb, conf, nms_threshold)
-        # 找到所有的non_keep索引
-        all_index = torch.arange(num_anchors, dtype=torch.long, device=device)
-        combined = torch.cat((keep, all_index))
-        uniques, counts = combined.unique(return_counts=True)
-        non_keep = uniques[counts == 1]
-        # 设置为背景类
-        class_id[non_keep] = -1
-        # class_id，conf, predicated_class 按照打分(conf)从高到低排序
-        all_id_sorted = torch.cat((keep, non_keep))
-        class_id = class_id[all_id_sorted]
-        conf = conf[all_id_sorted]
-        predicted_bb = predicted_bb[all_id_sorted]
-        # 对非背景项进行阈值处理
-        below_min_idx = (conf < pos_threshold)
-        class_id[below_min_idx] = -1
-        conf[below_min_idx] = 1 - conf[below_min_idx]   # 转化为背景的概率
-        # 在维度0上进行拼接: (num_anchor, 1) + (num_anchor, 1) + (num_anchor, 4) = (num_anchor, 6)
-        pred_info = torch.cat((class_id.unsqueeze(1), conf.unsqueeze(1), predicted_bb), dim=1)
-        out.append(pred_info)
-    # (batch_size, anchor_num, 6)
-    return torch.stack(out)
+    # 去除第一个背景类，得到每一个anchor概率最大的类别
+    # conf: (batch_size, num_anchor)
+    # class_id: (batch_size, num_anchor)
+    conf, class_id = torch.max(cls_probs[:, 1:], 1)
+    # predicted_bb: (batch_size, num_anchor, 4)
+    predicted_bb = offset_inverse(anchors, offset_preds.reshape(batch_size, -1, 4))
+    # order: (batch_size, num_anchor), 按照conf的分数从高到低排序的位置索引
+    # keep_mask: (batch_size, num_anchor), order中对应位置的anchor是否在nms后被保留
+    order, keep_mask = batched_nms(predicted_bb, conf, nms_threshold)
+    # 用scatter把排序位置上的保留标记和排名写回到anchor索引上
+    # kept: (batch_size, num_anchor), 每个anchor是否被保留
+    # rank: (batch_size, num_anchor), 每个anchor在按conf排序后的位置
+    kept = torch.zeros_like(keep_mask).scatter_(1, order, keep_mask)
+    all_index = torch.arange(num_anchors, dtype=torch.long, device=device).expand(batch_size, -1)
+    rank = torch.empty_like(order).scatter_(1, order, all_index)
+    # 保留的anchor按conf从高到低排在前面，其余(non_keep)按索引从小到大排在后面
+    sort_key = torch.where(kept, rank, num_anchors + all_index)
+    if top_k is None:
+        all_id_sorted = torch.argsort(sort_key, dim=1)
+    else:
+        all_id_sorted = torch.topk(sort_key, min(top_k, num_anchors), dim=1, largest=False).indices
+    # 将non_keep设置为背景类
+    class_id = torch.where(kept, class_id, -1)
+    # class_id，conf, predicated_class 按照打分(conf)从高到低排序
+    class_id = torch.gather(class_id, 1, all_id_sorted)
+    conf = torch.gather(conf, 1, all_id_sorted)
+    predicted_bb = torch.gather(predicted_bb, 1, all_id_sorted.unsqueeze(-1).expand(-1, -1, 4))
+    # 对非背景项进行阈值处理
+    below_min_idx = (conf < pos_threshold)
+    class_id = torch.where(below_min_idx, -1, class_id)
+    conf = torch.where(below_min_idx, 1 - conf, conf)   # 转化为背景的概率
+    # 在最后一维上进行拼接: (num_anchor, 1) + (num_anchor, 1) + (num_anchor, 4) = (num_anchor, 6)
+    # (batch_size, anchor_num, 6)，指定top_k时为(batch_size, top_k, 6)
+    return torch.cat((class_id.unsqueeze(-1), conf.unsqueeze(-1), predicted_bb), dim=-1)
+
+# 语义分割数据集
+d2l.DATA_HUB['voc2012'] = (d2l.DATA_URL + 'VOCtrainval_11-May-2012.tar',
+                           '4e443f8a2eca6b1dac8a6c57641b67dd40621a49')
+
+def read_voc_images(voc_dir, is_train=True):
+    txt_fname = os.path.join(voc_dir, 'ImageSets', 'Segmentation',
+                             'train.txt' if is_train else 'val.txt')
+    mode = torchvision.io.image.ImageReadMode.RGB
+    with open(txt_fname, 'r') as f:
+        images = f.read().split()
+    features, labels = [], []
+    for i, fname in enumerate(images):
+        features.append(torchvision.io.read_image(os.path.join(
+            voc_dir, 'JPEGImages', f'{fname}.jpg')))
+        # label数据不做存储格式的压缩
+        labels.append(torchvision.io.read_image(os.path.join(
+            voc_dir, 'SegmentationClass', f'{fname}.png'), mode))
+    return features, labels
+
+VOC_COLORMAP = [[0, 0, 0], [128, 0, 0], [0, 128, 0], [128, 128, 0],
+                [0, 0, 128], [128, 0, 128], [0, 128, 128], [128, 128, 128],
+                [64, 0, 0], [192, 0, 0], [64, 128, 0], [192, 128, 0],
+                [64, 0, 128], [192, 0, 128], [64, 128, 128], [192, 128, 128],
+                [0, 64, 0], [128, 64, 0], [0, 192, 0], [128, 192, 0],
+                [0, 64, 128]]
+VOC_CLASSES = ['background', 'aeroplane', 'bicycle', 'bird', 'boat',
+               'bottle', 'bus', 'car', 'cat', 'chair', 'cow',
+               'diningtable', 'dog', 'horse', 'motorbike', 'person',
+               'potted plant', 'sheep', 'sofa', 'train', 'tv/monitor']
+
+def voc_colormap2label():
+    # 将VOC_COLORMAP的RGB值编码为整数(r * 256 + g) * 256 + b并排序，用于二分查找
+    # 输出colormap_keys: (21) 排好序的颜色编码；colormap_labels: (21) 对应的VOC_COLORMAP索引号
+    colormap_keys = torch.tensor([(r * 256 + g) * 256 + b for r, g, b in VOC_COLORMAP])
+    colormap_keys, colormap_labels = torch.sort(colormap_keys)
+    return colormap_keys, colormap_labels.to(torch.uint8)
+
+def voc_label_indices(colormap, colormap2label=None):
+    # 将colormap的RGB值(255, 255, 255)映射到类别(VOC_COLORMAP)索引
+    # colormap: (..., channel, height, width)，可以是一张图片，也可以是一个批量，在所在设备上计算
+    # output: (..., height, width) uint8，值为VOC_COLORMAP的索引，不在VOC_COLORMAP中的颜色为0
+    if colormap2label is None:
+        colormap2label = voc_colormap2label()
+    colormap_keys, colormap_labels = [x.to(colormap.device) for x in colormap2label]
+    colormap = colormap.long()
+    # idx: (..., height, width)
+    idx = (colormap[..., 0, :, :] * 256 + colormap[..., 1, :, :]) * 256 + colormap[..., 2, :, :]
+    # 在21个排好序的颜色编码中二分查找，找到的位置上颜色编码相等才是有效的类别
+    pos = torch.searchsorted(colormap_keys, idx).clamp(max=len(colormap_keys) - 1)
+    return torch.where(colormap_keys[pos] == idx, colormap_labels[pos], 0)
+
+def voc_rand_crop(feature, label, height, width):
+    rec = torchvision.transforms.RandomCrop.get_params(feature, (height, width))
+    feature = torchvision.transforms.functional.crop(feature, *rec)
+    label = torchvision.transforms.functional.crop(label, *rec)
+    return feature, label
+
+def read_voc_image_paths(voc_dir, is_train=True):
+    """只读取图片的路径和尺寸，不解码图片
+    返回[(图片路径, 标签路径, (height, width))]，尺寸从图片文件头中读取，用于按crop_size过滤"""
+    txt_fname = os.path.join(voc_dir, 'ImageSets', 'Segmentation',
+                             'train.txt' if is_train else 'val.txt')
+    with open(txt_fname, 'r') as f:
+        images = f.read().split()
+    paths = []
+    for fname in images:
+        feature_path = os.path.join(voc_dir, 'JPEGImages', f'{fname}.jpg')
+        label_path = os.path.join(voc_dir, 'SegmentationClass', f'{fname}.png')
+        # PIL打开图片时只解析文件头，不会解码像素
+        with d2l.Image.open(feature_path) as img:
+            width, height = img.size
+        paths.append((feature_path, label_path, (height, width)))
+    return paths
+
+def voc_batch_rand_crop(features, labels, height, width):
+    """对一个批量的图片采样裁剪窗口，并把裁剪结果拼接成一个批量
+    features: [(channel, H_i, W_i)]，labels: [(..., H_i, W_i)]，每张图片的尺寸可以不同
+    输出: ((batch_size, channel, height, width), (batch_size, ..., height, width))，dtype与输入相同"""
+    # sizes: (batch_size, 2)，每个样本的(H_i, W_i)
+    sizes = torch.tensor([feature.shape[-2:] for feature in features])
+    # 一次性为整个批量采样左上角坐标，top在[0, H_i - height]中，left在[0, W_i - width]中均匀分布
+    corners = (torch.rand(len(features), 2) *
+               (sizes - torch.tensor([height, width]) + 1)).long().tolist()
+    # 裁剪只是取视图，拼接时直接从原图中拷贝裁剪区域，不产生中间的裁剪副本
+    features = torch.stack([feature[..., top:top + height, left:left + width]
+                            for feature, (top, left) in zip(features, corners)])
+    labels = torch.stack([label[..., top:top + height, left:left + width]
+                          for label, (top, left) in zip(labels, corners)])
+    return features, labels
+
+class VOCSegDataset(torch.utils.data.Dataset):
+    """VOC语义分割数据集
+    lazy=False时一次性读入所有图片，图片保存为uint8，标签保存为uint8的类别索引；
+    lazy=True时只保存文件路径，在__getitem__中(即DataLoader的worker中)解码、裁剪，内存占用与数据集大小无关
+    两种模式都是先裁剪再归一化，只对裁剪后的像素做浮点运算
+    idx为索引列表时按批量读取：整个批量一起采样裁剪窗口，拼接后只做一次归一化，
+    配合BatchSampler和batch_size=None的DataLoader使用，见load_data_voc"""
+    def __init__(self, is_train, crop_size, voc_dir, lazy=False):
+        self.transform = torchvision.transforms.Normalize(
+            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        # 把(X / 255 - mean) / std合并为X * scale - shift，批量归一化时只需要两次逐元素运算
+        std = torch.tensor(self.transform.std).reshape(3, 1, 1)
+        self.scale = 1 / (255 * std)
+        self.shift = torch.tensor(self.transform.mean).reshape(3, 1, 1) / std
+        self.crop_size = crop_size
+        self.lazy = lazy
+        self.colormap2label = voc_colormap2label()
+        if lazy:
+            self.paths = [path for path in read_voc_image_paths(voc_dir, is_train=is_train)
+                          if path[2][0] >= crop_size[0] and path[2][1] >= crop_size[1]]
+            num_examples = len(self.paths)
+        else:
+            features, labels = read_voc_images(voc_dir, is_train=is_train)
+            self.features = self.filter(features)
+            # 构造数据集时一次性把RGB标签转换为uint8的类别索引，每个样本只需要原来1/3的存储
+            self.labels = [voc_label_indices(label, self.colormap2label)
+                           for label in self.filter(labels)]
+            num_examples = len(self.features)
+        print('read ' + str(num_examples) + ' examples')
+
+    def normalize_image(self, img):
+        return self.transform(img.float() / 255)
+
+    def filter(self, imgs):
+        return [img for img in imgs if (
+                img.shape[1] >= self.crop_size[0] and img.shape[2] >= self.crop_size[1])]
+
+    def read_image(self, idx):
+        # 读取一个未裁剪的样本：((channel, H, W) uint8, 标签)，lazy模式下标签为RGB图片，否则为类别索引
+        if self.lazy:
+            feature_path, label_path, _ = self.paths[idx]
+            return (torchvision.io.read_image(feature_path),
+                    torchvision.io.read_image(label_path, torchvision.io.image.ImageReadMode.RGB))
+        return self.features[idx], self.labels[idx]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, tuple)):
+            return self.get_batch(idx)
+        # 每次获取item的时候，对feature和label进行相同的裁剪，裁剪之后再归一化
+        feature, label = voc_rand_crop(*self.read_image(idx), *self.crop_size)
+        if self.lazy:
+            # 只对裁剪后的标签做颜色到类别的映射
+            label = voc_label_indices(label, self.colormap2label)
+        # ((channel, height, width), (height, width))
+        return (self.normalize_image(feature), label.long())
+
+    def get_batch(self, indices):
+        features, labels = zip(*[self.read_image(idx) for idx in indices])
+        # features: (batch_size, channel, height, width) uint8
+        features, labels = voc_batch_rand_crop(features, labels, *self.crop_size)
+        if self.lazy:
+            labels = voc_label_indices(labels, self.colormap2label)
+        # 在主进程中直接把归一化结果写入锁页内存，之后可以异步拷贝到GPU；
+        # worker进程中由DataLoader的pin_memory负责锁页
+        pin = torch.cuda.is_available() and torch.utils.data.get_worker_info() is None
+        X = torch.empty(features.shape, dtype=torch.float32, pin_memory=pin)
+        torch.mul(features, self.scale, out=X).sub_(self.shift)
+        # ((batch_size, channel, height, width), (batch_size, height, width))
+        return (X, labels.long())
+
+    def __len__(self):
+        return len(self.paths) if self.lazy else len(self.features)
+
+def load_data_voc(batch_size, crop_size, lazy=False):
+    """加载VOC语义分割数据集，lazy=True时按需读取图片，并使用多个worker进程解码
+    DataLoader每次按一个批量的索引读取数据集，裁剪和归一化在整个批量上完成"""
+    voc_dir = d2l.download_extract('voc2012', os.path.join('VOCdevkit', 'VOC2012'))
+    num_workers = get_dataloader_workers() if lazy else 0
+    def data_loader(is_train):
+        dataset = VOCSegDataset(is_train, crop_size, voc_dir, lazy)
+        sampler = (torch.utils.data.RandomSampler if is_train
+                   else torch.utils.data.SequentialSampler)(dataset)
+        # batch_size=None关闭自动拼接，sampler直接产生一个批量的索引列表
+        return torch.utils.data.DataLoader(
+            dataset, batch_size=None,
+            sampler=torch.utils.data.BatchSampler(sampler, batch_size, drop_last=True),
+            num_workers=num_workers, pin_memory=torch.cuda.is_available())
+    return data_loader(True), data_loader(False)
+
+# Kaggle图像分类数据集
+def read_csv_labels(fname):
+    with open(fname, 'r') as f:
+        # 跳过文件头行(列名)
+        lines = f.readlines()[1:]
+    tokens = [l.rstrip().split(',') for l in lines]
+    return dict(((name, label) for name, label in tokens))
+
+def build_manifest(data_dir, labels, valid_ratio):
+    """按照reorg_train_valid和reorg_test的规则拆分训练集、验证集和测试集，但不复制任何图片，
+    只把拆分结果写到一个清单文件data_dir/train_valid_test.csv中，每行为(文件路径, 类别, 拆分)
+    清单文件名中带有数据集和valid_ratio的哈希，已经存在时直接跳过；返回清单文件的路径"""
+    train_files = sorted(os.listdir(os.path.join(data_dir, 'train')))
+    test_files = sorted(os.listdir(os.path.join(data_dir, 'test')))
+    sha1 = hashlib.sha1(f'{valid_ratio}'.encode())
+    for name in train_files:
+        sha1.update(f'{name}:{labels[name.split(".")[0]]}\n'.encode())
+    for name in test_files:
+        sha1.update(f'{name}\n'.encode())
+    manifest_fname = os.path.join(data_dir, f'train_valid_test_{sha1.hexdigest()[:12]}.csv')
+    if os.path.exists(manifest_fname):
+        return manifest_fname
+    # 训练数据集中样本最少的类别中的样本数
+    n = collections.Counter(labels.values()).most_common()[-1][1]
+    # 验证集中每个类别的样本数
+    n_valid_per_label = max(1, math.floor(n * valid_ratio))
+    label_count, rows = {}, []
+    for train_file in train_files:
+        label = labels[train_file.split('.')[0]]
+        if label_count.get(label, 0) < n_valid_per_label:
+            split = 'valid'
+            label_count[label] = label_count.get(label, 0) + 1
+        else:
+            split = 'train'
+        rows.append((os.path.join('train', train_file), label, split))
+    rows += [(os.path.join('test', test_file), 'unknown', 'test') for test_file in test_files]
+    # 先写临时文件再重命名，生成过程中被打断时不会留下不完整的清单
+    pd.DataFrame(rows, columns=['path', 'label', 'split']).to_csv(
+        manifest_fname + '.tmp', index=False)
+    os.replace(manifest_fname + '.tmp', manifest_fname)
+    return manifest_fname
+
+def read_manifest(manifest_fname):
+    """读取清单文件，返回{'train', 'valid', 'train_valid', 'test'}到[(文件路径, 类别)]的字典，
+    其中train_valid为train和valid的并集，文件路径相对于data_dir"""
+    manifest = pd.read_csv(manifest_fname, dtype=str, keep_default_na=False)
+    folders = {split: list(zip(manifest['path'][manifest['split'] == split],
+                               manifest['label'][manifest['split'] == split]))
+               for split in ('train', 'valid', 'test')}
+    folders['train_valid'] = folders['train'] + folders['valid']
+    return folders
+
+class ManifestImageFolder(torchvision.datasets.ImageFolder):
+    """直接按清单文件读取图片的ImageFolder，不需要把图片整理到data_dir/train_valid_test下
+    classes、class_to_idx、samples以及样本的顺序都与对整理后的目录使用ImageFolder时相同"""
+    def __init__(self, data_dir, manifest, folder, transform=None, target_transform=None):
+        # 与ImageFolder一样先按类别，再按文件名排序
+        self.entries = sorted(((os.path.join(data_dir, path), label)
+                               for path, label in manifest[folder]),
+                              key=lambda entry: (entry[1], os.path.basename(entry[0])))
+        super().__init__(data_dir, transform=transform, target_transform=target_transform)
+
+    def find_classes(self, directory):
+        classes = sorted(set(label for _, label in self.entries))
+        return classes, {cls_name: i for i, cls_name in enumerate(classes)}
+
+    def make_dataset(self, directory, class_to_idx, *args, **kwargs):
+        return [(path, class_to_idx[label]) for path, label in self.entries]
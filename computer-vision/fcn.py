@@ -57,7 +57,7 @@ net.transpose_conv.weight.data.copy_(W)
 
 # 读取数据集
 batch_size, crop_size = 32, (320, 480)
-train_iter, test_iter = d2l.load_data_voc(batch_size, crop_size)
+train_iter, test_iter = common.load_data_voc(batch_size, crop_size, lazy=True)
 
 # 训练
 def loss(inputs, targets):
@@ -74,12 +74,12 @@ def predict(img):
     return pred.reshape(pred.shape[1], pred.shape[2])
 
 def label2image(pred):
-    colormap = torch.tensor(d2l.VOC_COLORMAP)
+    colormap = torch.tensor(common.VOC_COLORMAP)
     X = pred.long()
     return colormap[X, :]
 
 voc_dir = d2l.download_extract('voc2012', 'VOCdevkit/VOC2012')
-test_images, test_labels = d2l.read_voc_images(voc_dir, False)
+test_images, test_labels = common.read_voc_images(voc_dir, False)
 n, imgs = 4, []
 for i in range(n):
     crop_rect = (0, 0, 320, 480)
@@ -1,9 +1,6 @@
 import common
-import collections
-import math
 import matplotlib.pyplot as plt
 import os
-import shutil
 import pandas as pd
 import torch
 import torchvision
@@ -32,43 +29,14 @@ labels = read_csv_labels(os.path.join(data_dir, 'trainLabels.csv'))
 print('# 训练样本：', len(labels))
 print('# 类别：', len(set(labels.values())), set(labels.values()))
 
-def copyfile(filename, target_dir):
-    """将文件复制到目标目录"""
-    os.makedirs(target_dir, exist_ok=True)
-    shutil.copy(filename, target_dir)
-
-def reorg_train_valid(data_dir, labels, valid_ratio):
-    """将验证集从原始的训练集中拆分出来"""
-    # 训练数据集中样本最少的类别中的样本数
-    n = collections.Counter(labels.values()).most_common()[-1][1]
-    # 验证集中每个类别的样本数
-    n_valid_per_label = max(1, math.floor(n * valid_ratio))
-    label_count = {}
-    for train_file in os.listdir(os.path.join(data_dir, 'train')):
-        label = labels[train_file.split('.')[0]]
-        fname = os.path.join(data_dir, 'train', train_file)
-        copyfile(fname, os.path.join(data_dir, 'train_valid_test', 'train_valid', label))
-        if label not in label_count or label_count[label] < n_valid_per_label:
-            copyfile(fname, os.path.join(data_dir, 'train_valid_test', 'valid', label))
-            label_count[label] = label_count.get(label, 0) + 1
-        else:
-            copyfile(fname, os.path.join(data_dir, 'train_valid_test', 'train', label))
-    return n_valid_per_label
-
-def reorg_test(data_dir):
-    """在预测期间整理测试集，以方便读取"""
-    for test_file in os.listdir(os.path.join(data_dir, 'test')):
-        copyfile(os.path.join(data_dir, 'test', test_file),
-                 os.path.join(data_dir, 'train_valid_test', 'test', 'unknown'))
-
 def reorg_cifar10_data(data_dir, valid_ratio):
+    # 逐个复制图片在完整数据集上需要几分钟，这里只生成拆分的清单文件，已经生成过时直接跳过
     labels = read_csv_labels(os.path.join(data_dir, 'trainLabels.csv'))
-    reorg_train_valid(data_dir, labels, valid_ratio)
-    reorg_test(data_dir)
+    return common.read_manifest(common.build_manifest(data_dir, labels, valid_ratio))
 
 batch_size = 32 if demo else 128
 valid_ratio = 0.1
-reorg_cifar10_data(data_dir, valid_ratio)
+manifest = reorg_cifar10_data(data_dir, valid_ratio)
 
 # 图像增广
 transform_train = torchvision.transforms.Compose([
@@ -87,11 +55,11 @@ transform_test = torchvision.transforms.Compose([
     torchvision.transforms.Normalize([0.4914, 0.4822, 0.4465], [0.2023, 0.1994, 0.2010])])
 
 # 读取数据集
-train_ds, train_valid_ds = [torchvision.datasets.ImageFolder(
-    os.path.join(data_dir, 'train_valid_test', folder),
+train_ds, train_valid_ds = [common.ManifestImageFolder(
+    data_dir, manifest, folder,
     transform=transform_train) for folder in ['train', 'train_valid']]
-valid_ds, test_ds = [torchvision.datasets.ImageFolder(
-    os.path.join(data_dir, 'train_valid_test', folder),
+valid_ds, test_ds = [common.ManifestImageFolder(
+    data_dir, manifest, folder,
     transform=transform_test) for folder in ['valid', 'test']]
 train_iter, train_valid_iter = [torch.utils.data.DataLoader(
     dataset, batch_size, shuffle=True, drop_last=True) for dataset in (train_ds, train_valid_ds)]
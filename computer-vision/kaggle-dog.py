@@ -17,15 +17,15 @@ else:
     data_dir = os.path.join('..', 'data', 'dog-breed-identification')
 
 def reorg_dog_data(data_dir, valid_ratio):
-    labels = d2l.read_csv_labels(os.path.join(data_dir, 'labels.csv'))
+    labels = common.read_csv_labels(os.path.join(data_dir, 'labels.csv'))
     print('# 训练样本：', len(labels))
     print('# 类别：', len(set(labels.values())), set(labels.values()))
-    d2l.reorg_train_valid(data_dir, labels, valid_ratio)
-    d2l.reorg_test(data_dir)
+    # 只生成拆分的清单文件，不复制图片，已经生成过时直接跳过
+    return common.read_manifest(common.build_manifest(data_dir, labels, valid_ratio))
 
 batch_size = 32 if demo else 128
 valid_ratio = 0.1
-reorg_dog_data(data_dir, valid_ratio)
+manifest = reorg_dog_data(data_dir, valid_ratio)
 
 # 图像增广
 transform_train = torchvision.transforms.Compose([
@@ -48,11 +48,11 @@ transform_test = torchvision.transforms.Compose([
                                      [0.229, 0.224, 0.225])])
 
 # 读取数据集
-train_ds, train_valid_ds = [torchvision.datasets.ImageFolder(
-    os.path.join(data_dir, 'train_valid_test', folder),
+train_ds, train_valid_ds = [common.ManifestImageFolder(
+    data_dir, manifest, folder,
     transform=transform_train) for folder in ['train', 'train_valid']]
-valid_ds, test_ds = [torchvision.datasets.ImageFolder(
-    os.path.join(data_dir, 'train_valid_test', folder),
+valid_ds, test_ds = [common.ManifestImageFolder(
+    data_dir, manifest, folder,
     transform=transform_test) for folder in ['valid', 'test']]
 train_iter, train_valid_iter = [torch.utils.data.DataLoader(
     dataset, batch_size, shuffle=True, drop_last=True)
@@ -141,7 +141,7 @@ for data, label in test_iter:
         data.to(devices[0])
     output = torch.nn.functional.softmax(net(data), dim=1)
     preds.extend(output.cpu().detach().numpy())
-ids = sorted(os.listdir(os.path.join(data_dir, 'train_valid_test', 'test', 'unknown')))
+ids = [os.path.basename(path) for path, _ in test_ds.samples]
 with open('submission_dog.csv', 'w') as f:
     f.write('id' + ','.join(train_valid_ds.classes) + '\n')
     for i, output in zip(ids, preds):
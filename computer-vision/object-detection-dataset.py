@@ -1,3 +1,4 @@
+import common
 import matplotlib.pyplot as plt
 import os
 import pandas as pd
@@ -64,3 +65,11 @@ for ax, label in zip(axes, batch[1][0:10]):
     # 乘以edge_size 是因为标注框变长被归一化到了[0,1]
     d2l.show_bboxes(ax, [label[0][1:5] * edge_size], colors=['w'])
 plt.show()
+
+# 使用预处理的缓存读取数据集：第一次运行时解码全部图片并写入.npy缓存，之后直接以内存映射的方式打开
+# 缓存返回uint8图片，在整个批量上再转换为浮点数
+timer = d2l.Timer()
+cached_train_iter, cached_test_iter = common.load_data_bananas(batch_size)
+print(f'load cached bananas: {timer.stop():.3f} sec')
+features, target = next(iter(cached_train_iter))
+print(features.dtype, features.float().shape, target.shape)
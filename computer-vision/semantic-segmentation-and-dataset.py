@@ -1,5 +1,6 @@
 import os
 
+import common
 import matplotlib.pyplot as plt
 import torch
 import torchvision
@@ -46,23 +47,23 @@ VOC_CLASSES = ['background', 'aeroplane', 'bicycle', 'bird', 'boat',
 
 def voc_colormap2label():
     # RGB(255, 255, 255)到类别(VOC_COLORMAP)索引
-    # 输出colormap2label (256^3) 的bitmap，默认值为0；有效值为VOC_COLORMAP的索引号
-    colormap2label = torch.zeros(256 ** 3, dtype=torch.long)
-    for i, colormap in enumerate(VOC_COLORMAP):
-        colormap2label[(colormap[0] * 256 + colormap[1]) * 256 + colormap[2]] = i
-    return colormap2label
+    # 不再构造(256^3)的查找表，只需把21个颜色编码为整数(r * 256 + g) * 256 + b并排序，用二分查找
+    # 输出colormap_keys: (21) 排好序的颜色编码；colormap_labels: (21) 对应的VOC_COLORMAP索引号
+    colormap_keys = torch.tensor([(r * 256 + g) * 256 + b for r, g, b in VOC_COLORMAP])
+    colormap_keys, colormap_labels = torch.sort(colormap_keys)
+    return colormap_keys, colormap_labels.to(torch.uint8)
 
 def voc_label_indices(colormap, colormap2label):
     # 将colormap的RGB值(255, 255, 255)映射到类别(VOC_COLORMAP)索引
-    # colormap: (channel, height, width)
-    # colormap2label: (256^3)
-    # output: (height, width) 值为VOC_COLORMAP的索引
-    print(colormap.shape)
-    print(colormap2label.shape)
-    colormap = colormap.permute(1, 2, 0).numpy().astype('int32')
-    # idx: (height, width)
-    idx = (colormap[:, :, 0] * 256 + colormap[:, :, 1]) * 256 + colormap[:, :, 2]
-    return colormap2label[idx]
+    # colormap: (..., channel, height, width)
+    # colormap2label: ((21), (21))
+    # output: (..., height, width) uint8，值为VOC_COLORMAP的索引，不在VOC_COLORMAP中的颜色为0
+    colormap_keys, colormap_labels = [x.to(colormap.device) for x in colormap2label]
+    colormap = colormap.long()
+    # idx: (..., height, width)
+    idx = (colormap[..., 0, :, :] * 256 + colormap[..., 1, :, :]) * 256 + colormap[..., 2, :, :]
+    pos = torch.searchsorted(colormap_keys, idx).clamp(max=len(colormap_keys) - 1)
+    return torch.where(colormap_keys[pos] == idx, colormap_labels[pos], 0)
 
 y = voc_label_indices(train_labels[0], voc_colormap2label())
 print(y[105:115, 130:140])
@@ -89,9 +90,11 @@ class VOCSegDataset(torch.utils.data.Dataset):
             mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         self.crop_size = crop_size
         features, labels = read_voc_images(voc_dir, is_train=is_train)
-        self.features = [self.normalize_image(feature) for feature in self.filter(features)]
-        self.labels = self.filter(labels)
-        self.colormap2label = voc_colormap2label()
+        # 图片保持uint8存储，裁剪之后再归一化，避免在内存中保存整张图片的float32副本
+        self.features = self.filter(features)
+        # 构造数据集时一次性把RGB标签转换为uint8的类别索引，之后只需裁剪
+        colormap2label = voc_colormap2label()
+        self.labels = [voc_label_indices(label, colormap2label) for label in self.filter(labels)]
         print('read ' + str(len(self.features)) + ' examples')
 
     def normalize_image(self, img):
@@ -102,10 +105,10 @@ class VOCSegDataset(torch.utils.data.Dataset):
                 img.shape[1] >= self.crop_size[0] and img.shape[2] >= self.crop_size[1])]
 
     def __getitem__(self, idx):
-        # 每次获取item的时候，对feature和item进行相同的裁剪，并将label的rgb值映射到类别索引
+        # 每次获取item的时候，对feature和label进行相同的裁剪
         feature, label = voc_rand_crop(self.features[idx], self.labels[idx], *self.crop_size)
-        # ((height, width, channel), (height, width))
-        return (feature, voc_label_indices(label, self.colormap2label))
+        # ((channel, height, width), (height, width))
+        return (self.normalize_image(feature), label.long())
 
     def __len__(self):
         return len(self.features)
@@ -132,3 +135,17 @@ def load_data_voc(batch_size, crop_size):
         VOCSegDataset(False, crop_size, voc_dir), batch_size,
         drop_last=True)
     return train_iter, test_iter
+
+# 按需读取：数据集只保存文件路径，在DataLoader的worker中解码、裁剪和归一化
+train_iter, test_iter = common.load_data_voc(batch_size, crop_size, lazy=True)
+for X, Y in train_iter:
+    print(X.shape)
+    print(Y.shape)
+    break
+
+# 批量裁剪和归一化：一次为整个批量采样裁剪窗口，拼接后只对裁剪出的像素做一次归一化
+train_iter, test_iter = common.load_data_voc(batch_size, crop_size)
+for X, Y in train_iter:
+    print(X.shape)
+    print(Y.shape)
+    break
@@ -83,13 +83,16 @@ def get_blk(i):
         blk = down_sample_blk(128, 128)
     return blk
 
+# anchor只和Y的形状、sizes、ratios有关系，按形状缓存，同样大小的特征图只计算一次
+anchor_generator = common.AnchorGenerator()
+
 def blk_forward(X, blk, size, ratio, cls_preditor, bbox_preditor):
     # Y = feature_map: (batch_size, channel, height, width)
     Y = blk(X)
     # (1, (height * width) * num_anchor, 4)
     # num_anchor = num_sizes + num_ratios - 1
-    # TODO(rogerluo): anchor只和Y的形状有关系，可以提前计算好
-    anchors = common.multibox_prior(Y, sizes=size, ratios=ratio)
+    # size为None时表示使用提前计算好的锚框，不再生成当前阶段的锚框
+    anchors = None if size is None else anchor_generator(Y, sizes=size, ratios=ratio)
     # (batch_size, num_anchors * num_classes, height, width)
     # cls_preditor需要知道num_anchors，在构造cls_preditor时获得该信息
     # cls_preditor并不需要每一个anchor的信息，anchors信息会在计算loss的时候被用到
@@ -113,15 +116,39 @@ class TinySSD(nn.Module):
             setattr(self, f'blk_{i}', get_blk(i))
             setattr(self, f'cls_{i}', cls_predictor(idx_to_in_channels[i], num_anchors, num_classes))
             setattr(self, f'bbox_{i}', bbox_predictor(idx_to_in_channels[i], num_anchors))
+        # 固定输入尺寸时提前拼接好的锚框: ((height, width, device, dtype), anchors)
+        self.fixed_anchors = None
+
+    def precompute_anchors(self, input_size, device=None, dtype=torch.float32):
+        """为固定的输入尺寸提前计算所有阶段拼接好的锚框，forward时直接复用"""
+        # 用一个样本跑一遍各个阶段的网络块，得到每个阶段特征图的高宽
+        training, feature_shapes = self.training, []
+        X = torch.zeros((1, 3, *input_size), device=device, dtype=dtype)
+        self.eval()
+        with torch.no_grad():
+            for i in range(5):
+                X = getattr(self, f'blk_{i}')(X)
+                feature_shapes.append(tuple(X.shape[-2:]))
+        self.train(training)
+        anchors = anchor_generator.precompute(feature_shapes, sizes, ratios, device, dtype)
+        self.fixed_anchors = ((*input_size, anchors.device, dtype), anchors)
+        return anchors
 
     def forward(self, X):
+        input_key = (*X.shape[-2:], X.device, X.dtype)
+        # 输入尺寸与提前计算时一致时，各个阶段不再生成锚框
+        use_fixed = self.fixed_anchors is not None and self.fixed_anchors[0] == input_key
         anchors, cls_preds, bbox_preds = [None] * 5, [None] * 5, [None] * 5
         for i in range(5):
             X, anchors[i], cls_preds[i], bbox_preds[i] = blk_forward(
-                X, getattr(self, f'blk_{i}'), sizes[i], ratios[i],
+                X, getattr(self, f'blk_{i}'), None if use_fixed else sizes[i], ratios[i],
                 getattr(self, f'cls_{i}'), getattr(self, f'bbox_{i}'))
-        # [(1, height * width * num_anchor, 4) -> (1, sum(height * width * num_anchor), 4)
-        anchors = torch.cat(anchors, dim=1)
+        if use_fixed:
+            # 输入尺寸与提前计算时一致，直接复用拼接好的锚框
+            anchors = self.fixed_anchors[1]
+        else:
+            # [(1, height * width * num_anchor, 4) -> (1, sum(height * width * num_anchor), 4)
+            anchors = torch.cat(anchors, dim=1)
         # [(batch_size, num_anchor * num_class, height, width)] ->
         # (batch_size, sum(height * weight * num_anchor * num_class))
         cls_preds = concat_preds(cls_preds)
@@ -153,7 +180,7 @@ print('output bbox preds:', bbox_preds.shape)
 # 训练模型
 # 读取数据集和初始化
 batch_size = 32
-train_iter, _ = d2l.load_data_bananas(batch_size)
+train_iter, _ = common.load_data_bananas(batch_size)
 # TODO(rogerluo): 使用mps进行训练，会有bug
 device, net = common.try_gpu(), TinySSD(num_classes=1)
 trainer = torch.optim.SGD(net.parameters(), lr=0.2, weight_decay=5e-4)
@@ -185,6 +212,8 @@ def bbox_eval(bbox_preds, bbox_labels, bbox_masks):
 num_epochs, timer = 20, d2l.Timer()
 animator = d2l.Animator(xlabel='epoch', xlim=[1, num_epochs], legend=['class error', 'bbox mae'])
 net = net.to(device)
+# 训练图片的尺寸固定为256 * 256，提前计算好锚框
+net.precompute_anchors((256, 256), device)
 print('train on device: ', device)
 for epoch in range(num_epochs):
     metric = d2l.Accumulator(4)
@@ -195,7 +224,8 @@ for epoch in range(num_epochs):
         trainer.zero_grad()
         # X: (batch_size, channel, height, width) (32, 3, 256, 256)
         # Y: (batch_size, 1, 5) (32, 1, 5)
-        X, Y = features.to(device), target.to(device)
+        # 数据集返回uint8图片，搬到设备上之后再在整个批量上转换为浮点数
+        X, Y = features.to(device).float(), target.to(device)
         # 预测每个锚框的类别和偏移量
         # anchors: (1, total_num_anchor, 4)
         # cls_preds: (batch_size, total_num_anchor, num_class)
@@ -239,11 +269,9 @@ def predict(X):
     cls_probs = F.softmax(cls_preds, dim=2).permute(0, 2, 1)
     # output: (batch_size, anchor_num, 6)
     output = common.multibox_detection(cls_probs, bbox_preds, anchors)
-    # 过滤背景类
-    idx = [i for i, row in enumerate(output[0]) if row[0] != -1]
-    # 返回非背景类anchor的类别、预测值、坐标
+    # 过滤背景类，返回非背景类anchor的类别、预测值、坐标
     # (valid_anchor_num, 6)
-    return output[0, idx]
+    return output[0][output[0, :, 0] != -1]
 
 output = predict(X)
 print(output)
@@ -262,3 +290,12 @@ def display(img, output, thredshold):
 
 display(img, output.cpu(), thredshold=0.9)
 plt.show()
+
+# 批量预测：整个批量一起做后处理，结果与逐张图片调用multibox_detection相同
+features, _ = next(iter(train_iter))
+with torch.no_grad():
+    anchors, cls_preds, bbox_preds = net(features.to(device).float())
+cls_probs = F.softmax(cls_preds, dim=2).permute(0, 2, 1)
+output = common.multibox_detection(cls_probs, bbox_preds, anchors)
+assert all(torch.equal(output[i:i + 1], common.multibox_detection(cls_probs[i:i + 1], bbox_preds[i:i + 1], anchors))
+           for i in range(len(features)))
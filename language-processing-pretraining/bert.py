@@ -1,10 +1,15 @@
 from torch.utils.data import Dataset
 
+import collections
 import common
+import copy
+import json
 import matplotlib.pyplot as plt
+import numpy as np
 import os
 import random
 import torch
+import types
 from d2l import torch as d2l
 from torch import nn
 
@@ -61,82 +66,32 @@ def _get_nsp_data_from_paragraph(paragraph, paragraphs, vocab, max_len):
     # [([tokens], [segments], is_next)] 数组
     return nps_data_from_paragraph
 
-# 生成遮蔽语言模型任务的数据
-def _replace_mlm_tokens(tokens, candidate_pred_positions, num_mlm_preds, vocab):
-    mlm_inputs_tokens = [token for token in tokens]
-    pred_positions_and_labels = []
-    # 随机打乱后，选取15%的词元
-    random.shuffle(candidate_pred_positions)
-    for mlm_pred_position in candidate_pred_positions:
-        if len(pred_positions_and_labels) >= num_mlm_preds:
-            break
-        masked_token = None
-        if random.random() < 0.8:
-            # 80% 替换为<mask>
-            masked_token = '<mask>'
-        else:
-            if random.random() < 0.5:
-                # 10% 保持原词。这种情况下直接透露了结果，原因是在fine tune的时候，不会做任何mask。
-                masked_token = tokens[mlm_pred_position]
-            else:
-                # 10% 替换为随机词
-                masked_token = random.choice(vocab.idx_to_token)
-        mlm_inputs_tokens[mlm_pred_position] = masked_token
-        pred_positions_and_labels.append((mlm_pred_position, tokens[mlm_pred_position]))
-    # tokens, [(position, labels)]
-    return mlm_inputs_tokens, pred_positions_and_labels
-
-def _get_mlm_data_from_tokens(tokens, vocab):
-    # tokens: [string]
-    candidate_pred_positioh = []
-    for i, token in enumerate(tokens):
-        if token in ['<cls', '<sep>']:
-            continue
-        candidate_pred_positioh.append(i)
-    # 15%的词元进行替换
-    num_mlm_preds = max(1, round(len(tokens) * 0.15))
-    # tokens, [(position, labels)]
-    mlm_input_tokens, pred_positions_and_labels = _replace_mlm_tokens(
-        tokens, candidate_pred_positioh, num_mlm_preds, vocab)
-    pred_positions_and_labels = sorted(pred_positions_and_labels, key=lambda x:x[0])
-    pred_positions = [v[0] for v in pred_positions_and_labels]
-    mlm_pred_labels = [v[1] for v in pred_positions_and_labels]
-    # tokens_ids, pred_positions, labels_ids
-    return vocab[mlm_input_tokens], pred_positions, vocab[mlm_pred_labels]
-
 # 将文本转换为预训练数据集
 def _pad_bert_inputs(examples, max_len, vocab):
-    max_num_mlm_preds = round(max_len * 0.15)
-    all_tokens_ids, all_segments, valid_lens = [], [], []
-    all_pred_positions, all_mlm_weights, all_mlm_labels = [], [], []
-    nsp_labels = []
-    for (token_ids, pred_positions, mlm_pred_label_ids, segments, is_next) in examples:
-        all_tokens_ids.append(
-            torch.tensor(token_ids + [vocab['<pad>']] * (
-                    max_len - len(token_ids)), dtype=torch.long))
-        all_segments.append(
-            torch.tensor(segments + [0] * (
-                    max_len - len(segments)), dtype=torch.long))
-        valid_lens.append(
-            torch.tensor(len(token_ids), dtype=torch.float32))
-        all_pred_positions.append(
-            torch.tensor(pred_positions + [0] *(
-                max_num_mlm_preds - len(pred_positions)), dtype=torch.long))
-        # 填充词元的预测将通过乘以0权重在损失中过滤掉
-        all_mlm_weights.append(
-            torch.tensor([1.0] * len(mlm_pred_label_ids) + [0.0] * (
-                max_num_mlm_preds - len(pred_positions)), dtype=torch.float32))
-        all_mlm_labels.append(
-            torch.tensor(mlm_pred_label_ids + [0] * (
-                max_num_mlm_preds - len(mlm_pred_label_ids)), dtype=torch.long))
-        nsp_labels.append(
-            torch.tensor(is_next, dtype=torch.long))
-    return (all_tokens_ids, all_segments, valid_lens, all_pred_positions,
-            all_mlm_weights, all_mlm_labels, nsp_labels)
+    # examples: [(tokens, segments, is_next)]，tokens: [string]
+    # 每个字段只保存一个连续的紧凑整数数组，而不是每个样本一个小张量：
+    # all_token_ids: (num_examples, max_len) int32；all_segments: (num_examples, max_len) int8
+    # valid_lens: (num_examples) int16；nsp_labels: (num_examples) int8
+    token_to_idx, unk = vocab.token_to_idx, vocab.unk()
+    # 只遍历一遍样本，把所有词元索引和片段索引依次放到一维列表中
+    flat_token_ids, flat_segments, lens, nsp_labels = [], [], [], []
+    for tokens, segments, is_next in examples:
+        flat_token_ids.extend(token_to_idx.get(token, unk) for token in tokens)
+        flat_segments.extend(segments)
+        lens.append(len(tokens))
+        nsp_labels.append(is_next)
+    valid_lens = torch.tensor(lens, dtype=torch.int16)
+    # mask: (num_examples, max_len)，按行展开后的True位置与一维列表中的元素一一对应
+    mask = torch.arange(max_len) < valid_lens.unsqueeze(1)
+    all_token_ids = torch.full(mask.shape, vocab['<pad>'], dtype=torch.int32)
+    all_token_ids[mask] = torch.tensor(flat_token_ids, dtype=torch.int32)
+    all_segments = torch.zeros(mask.shape, dtype=torch.int8)
+    all_segments[mask] = torch.tensor(flat_segments, dtype=torch.int8)
+    return all_token_ids, all_segments, valid_lens, torch.tensor(nsp_labels, dtype=torch.int8)
 
 class _WikiTextDataset(Dataset):
     # paragraphs: [段落，句子] 二维数组
-    def __init__(self, paragraphs, max_len):
+    def __init__(self, paragraphs, max_len, dynamic_masking=False):
         # paragraphs: [[tokens]] 段落 -> 句子, tokens: [string]
         paragraphs = [[line.split() for line in paragraph] for paragraph in paragraphs]
         # sentences: [tokens], tokens: [string]
@@ -149,29 +104,208 @@ class _WikiTextDataset(Dataset):
             # examples: [(tokens, segments, is_next)] 数组, tokens: [string]
             examples.extend(_get_nsp_data_from_paragraph(paragraph, paragraphs,
                                                          self.vocab, max_len))
-        # 获取遮蔽语言模型任务的数据
-        # examples: [(tokens_idx, pred_positions, labels_idx, segments, is_next)]
-        examples = [(_get_mlm_data_from_tokens(tokens, self.vocab) + (segments, is_next))
-                    for tokens, segments, is_next in examples]
         # 填充输入
         (self.all_token_ids, self.all_segments, self.valid_lens,
-         self.all_pred_positions, self.all_mlm_weights, self.all_mlm_labels,
          self.nsp_labels) = _pad_bert_inputs(examples, max_len, self.vocab)
+        # dynamic_masking为True时只保存未遮蔽的句子对，由common.MLMCollate在每个批量上重新遮蔽
+        self.dynamic_masking = dynamic_masking
+        if not dynamic_masking:
+            # 获取遮蔽语言模型任务的数据，在整个数据集的词元索引矩阵上一次完成
+            (self.all_token_ids, all_pred_positions, all_mlm_weights,
+             self.all_mlm_labels) = common.mask_mlm_tokens(self.all_token_ids, self.valid_lens,
+                                                           self.vocab)
+            # 预测位置不超过max_len，权重只有0和1，同样以紧凑的类型保存
+            self.all_pred_positions = all_pred_positions.to(torch.int16)
+            self.all_mlm_weights = all_mlm_weights.to(torch.bool)
 
     def __getitem__(self, idx):
-        return  (self.all_token_ids[idx], self.all_segments[idx], self.valid_lens[idx],
-         self.all_pred_positions[idx], self.all_mlm_weights[idx], self.all_mlm_labels[idx],
-         self.nsp_labels[idx])
+        # idx可以是一个样本的索引，也可以是一个批量的索引列表(见load_data_wiki)，
+        # 按批量读取时每个字段只需一次索引，再转换为模型需要的类型
+        if isinstance(idx, list):
+            idx = torch.tensor(idx)
+        inputs = (self.all_token_ids[idx].long(), self.all_segments[idx].long(),
+                  self.valid_lens[idx].float())
+        if self.dynamic_masking:
+            return inputs + (self.nsp_labels[idx].long(),)
+        return inputs + (self.all_pred_positions[idx].long(), self.all_mlm_weights[idx].float(),
+                         self.all_mlm_labels[idx].long(), self.nsp_labels[idx].long())
 
     def __len__(self):
         return len(self.all_token_ids)
 
-def load_data_wiki(batch_size, max_len):
+def _get_wiki_iter(train_set, batch_size, dynamic_padding=False, num_workers=0):
+    # batch_size=None关闭自动拼接，sampler直接产生一个批量的索引列表，数据集按批量切片
+    # dynamic_padding为True时按有效长度分桶，并把每个批量截断到其中最长的序列
+    if dynamic_padding:
+        sampler = common.BucketBatchSampler(train_set.valid_lens, batch_size)
+    else:
+        sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(train_set),
+                                                batch_size, drop_last=False)
+    if train_set.dynamic_masking:
+        # 在DataLoader的worker中为每个批量重新生成遮蔽
+        return torch.utils.data.DataLoader(
+            train_set, batch_size=None, sampler=sampler,
+            collate_fn=common.MLMCollate(train_set.vocab, dynamic_padding=dynamic_padding),
+            num_workers=num_workers)
+    return torch.utils.data.DataLoader(
+        train_set, batch_size=None, sampler=sampler,
+        collate_fn=common.pad_to_longest if dynamic_padding else None)
+
+# num_workers: DataLoader的worker数，默认为0，在当前进程中读取。
+#     大于0时，spawn/forkserver启动方式下worker会重新导入主模块，
+#     调用的脚本需要把读取数据的代码放在 if __name__ == '__main__': 之下
+def load_data_wiki(batch_size, max_len, dynamic_masking=False, dynamic_padding=False, num_workers=0):
     data_dir = d2l.download_extract('wikitext-2', 'wikitext-2')
     paragraphs = _read_wiki(data_dir)
-    train_set = _WikiTextDataset(paragraphs, max_len)
-    train_iter = torch.utils.data.DataLoader(train_set, batch_size, shuffle=True)
-    return train_iter, train_set.vocab
+    train_set = _WikiTextDataset(paragraphs, max_len, dynamic_masking)
+    return _get_wiki_iter(train_set, batch_size, dynamic_padding, num_workers), train_set.vocab
+
+# 流式读取的预训练数据集
+def _iter_wiki_paragraphs(file_name):
+    # 逐行读取，与_read_wiki的规则相同，每次产生一个段落：[sentence]，sentence: [string]
+    with open(file_name, 'r') as f:
+        for line in f:
+            if len(line.split('.')) >= 2:
+                yield [sentence.split() for sentence in line.strip().lower().split('.')]
+
+def write_wiki_shards(data_dir, shard_dir, shard_size=2 ** 20, min_freq=5):
+    """把语料转换为二进制分片，每个分片约shard_size个词元，不在内存中保存整个语料
+    第一遍流式统计词频并构建词表，第二遍把每个句子转换为词元索引，写入shard_*.npz：
+    tokens为所有句子的词元索引拼接成的int32数组，lengths为每个句子的长度，paragraphs为句子所属的段落编号
+    一个段落不会被拆分到两个分片中；分片目录中已经有相同参数生成的shards.json时直接读取，
+    参数不同时删除旧的分片并重新生成，返回(分片文件列表, 词表)"""
+    index_fname = os.path.join(shard_dir, 'shards.json')
+    params = {'shard_size': shard_size, 'min_freq': min_freq}
+    if os.path.exists(index_fname):
+        with open(index_fname, 'r') as f:
+            index = json.load(f)
+        if index.get('params') != params:
+            os.remove(index_fname)
+            for fname in index['shards']:
+                os.remove(os.path.join(shard_dir, fname))
+            return write_wiki_shards(data_dir, shard_dir, shard_size, min_freq)
+        vocab = common.Vocab()
+        vocab.idx_to_token = index['idx_to_token']
+        vocab.token_to_idx = {token: idx for idx, token in enumerate(vocab.idx_to_token)}
+        return [os.path.join(shard_dir, fname) for fname in index['shards']], vocab
+    file_name = os.path.join(data_dir, 'wiki.train.tokens')
+    counter = collections.Counter(token for paragraph in _iter_wiki_paragraphs(file_name)
+                                  for sentence in paragraph for token in sentence)
+    vocab = common.Vocab(counter, min_freq=min_freq,
+                         reserved_tokens=['<pad>', '<mask>', '<cls>', '<sep>'])
+    os.makedirs(shard_dir, exist_ok=True)
+    token_to_idx, unk = vocab.token_to_idx, vocab.unk()
+    shards, tokens, lengths, paragraphs = [], [], [], []
+
+    def flush():
+        fname = f'shard_{len(shards):05d}.npz'
+        np.savez(os.path.join(shard_dir, fname), tokens=np.array(tokens, dtype=np.int32),
+                 lengths=np.array(lengths, dtype=np.int32),
+                 paragraphs=np.array(paragraphs, dtype=np.int64))
+        shards.append(fname)
+        tokens.clear()
+        lengths.clear()
+        paragraphs.clear()
+
+    for paragraph_idx, paragraph in enumerate(_iter_wiki_paragraphs(file_name)):
+        for sentence in paragraph:
+            tokens.extend(token_to_idx.get(token, unk) for token in sentence)
+            lengths.append(len(sentence))
+            paragraphs.append(paragraph_idx)
+        if len(tokens) >= shard_size:
+            flush()
+    if lengths:
+        flush()
+    # 最后写入索引文件，写分片的过程中被打断时会重新生成
+    with open(index_fname, 'w') as f:
+        json.dump({'params': params, 'shards': shards, 'idx_to_token': vocab.idx_to_token}, f)
+    return [os.path.join(shard_dir, fname) for fname in shards], vocab
+
+class _WikiTextStream(torch.utils.data.IterableDataset):
+    """按需读取分片的预训练数据集，内存占用只与一个分片和缓冲区的大小有关
+    每个epoch打乱分片的顺序，多个DataLoader worker时所有worker按相同的顺序打乱后各自读取不同的分片；
+    同一段落中相邻的句子对先放入大小为buffer_size的缓冲区，再从中随机取出，
+    下一句预测的负例也从缓冲区中随机选取
+    产生未遮蔽的样本(token_ids, segments, valid_len, nsp_label)，配合common.MLMCollate使用"""
+    def __init__(self, shard_fnames, vocab, max_len, buffer_size=10000):
+        self.shard_fnames = shard_fnames
+        self.vocab = vocab
+        self.max_len = max_len
+        self.buffer_size = buffer_size
+        # 已经开始的epoch数，persistent_workers时同一个worker会被多次迭代
+        self.epoch = 0
+
+    def _worker_shards(self, worker_info=None):
+        """当前epoch中当前worker要读取的分片，worker_info为None时从DataLoader获取"""
+        shard_fnames = list(self.shard_fnames)
+        if worker_info is None:
+            worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            random.shuffle(shard_fnames)
+            return shard_fnames
+        # 每个worker的种子为base_seed + id，同一个epoch中所有worker的base_seed相同，
+        # 用它和epoch打乱分片，所有worker得到相同的顺序，切片后每个分片恰好被一个worker读取
+        random.Random(worker_info.seed - worker_info.id + self.epoch).shuffle(shard_fnames)
+        self.epoch += 1
+        return shard_fnames[worker_info.id::worker_info.num_workers]
+
+    def _iter_pairs(self):
+        for shard_fname in self._worker_shards():
+            with np.load(shard_fname) as shard:
+                tokens, lengths, paragraphs = shard['tokens'], shard['lengths'], shard['paragraphs']
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            # 同一段落中相邻的两个句子构成一个句子对
+            for i in np.nonzero(paragraphs[:-1] == paragraphs[1:])[0]:
+                yield (tokens[offsets[i]:offsets[i + 1]],
+                       tokens[offsets[i + 1]:offsets[i + 2]])
+
+    def _get_example(self, tokens_a, tokens_b, buffer):
+        if random.random() < 0.5:
+            is_next = True
+        else:
+            tokens_b = random.choice(buffer)[random.randint(0, 1)]
+            is_next = False
+        # 1个<cls>和2个<sep>
+        valid_len = len(tokens_a) + len(tokens_b) + 3
+        if valid_len > self.max_len:
+            return None
+        token_ids = torch.full((self.max_len,), self.vocab['<pad>'], dtype=torch.long)
+        token_ids[:valid_len] = torch.from_numpy(np.concatenate([
+            [self.vocab['<cls>']], tokens_a, [self.vocab['<sep>']], tokens_b,
+            [self.vocab['<sep>']]]).astype(np.int64))
+        segments = torch.zeros(self.max_len, dtype=torch.long)
+        segments[len(tokens_a) + 2:valid_len] = 1
+        return (token_ids, segments, torch.tensor(valid_len, dtype=torch.float32),
+                torch.tensor(is_next, dtype=torch.long))
+
+    def __iter__(self):
+        buffer = []
+        for pair in self._iter_pairs():
+            if len(buffer) < self.buffer_size:
+                buffer.append(pair)
+                continue
+            # 缓冲区已满：随机取出一个句子对，用新的句子对填补它的位置
+            i = random.randrange(len(buffer))
+            pair, buffer[i] = buffer[i], pair
+            example = self._get_example(*pair, buffer)
+            if example is not None:
+                yield example
+        random.shuffle(buffer)
+        for pair in buffer:
+            example = self._get_example(*pair, buffer)
+            if example is not None:
+                yield example
+
+def load_data_wiki_stream(batch_size, max_len, shard_size=2 ** 20, buffer_size=10000, num_workers=0):
+    data_dir = d2l.download_extract('wikitext-2', 'wikitext-2')
+    shard_fnames, vocab = write_wiki_shards(data_dir, os.path.join(data_dir, 'shards'),
+                                            shard_size)
+    train_set = _WikiTextStream(shard_fnames, vocab, max_len, buffer_size)
+    # 每个worker读取不同的分片，并在collate_fn中动态遮蔽
+    train_iter = torch.utils.data.DataLoader(
+        train_set, batch_size, collate_fn=common.MLMCollate(vocab),
+        num_workers=min(num_workers, len(shard_fnames)))
+    return train_iter, vocab
 
 batch_size, max_len = 512, 64
 train_iter, vocab = load_data_wiki(batch_size, max_len)
@@ -186,6 +320,29 @@ for (tokens_X, segments_X, valid_lens_x, pred_positions_X, mlm_weights_X, mlm_Y,
     break
 print(len(vocab))
 
+# 动态遮蔽：数据集只保存句子对，每个批量在collate_fn中重新遮蔽，每个epoch遮蔽的位置都不同
+dynamic_iter, _ = load_data_wiki(batch_size, max_len, dynamic_masking=True)
+for epoch in range(2):
+    for batch in dynamic_iter:
+        print(f'epoch {epoch + 1} pred_positions_X', batch[3][0])
+        break
+
+# 流式读取：语料先转换为二进制分片，训练时按需读取分片，并用有限大小的缓冲区打乱
+stream_iter, _ = load_data_wiki_stream(batch_size, max_len)
+for batch in stream_iter:
+    print('stream', [x.shape for x in batch])
+    break
+# 多个worker时，每个epoch中每个分片恰好被读取一次：
+# 每个worker持有数据集的一份拷贝，种子为base_seed + id，DataLoader每个epoch重新生成base_seed
+shard_fnames, num_workers = stream_iter.dataset.shard_fnames, 3
+workers = [copy.copy(stream_iter.dataset) for _ in range(num_workers)]
+for epoch in range(2):
+    base_seed = random.randrange(2 ** 32)
+    read_shards = [shard_fname for i, worker in enumerate(workers) for shard_fname in worker._worker_shards(
+        types.SimpleNamespace(id=i, num_workers=num_workers, seed=base_seed + i))]
+    print(f'epoch {epoch + 1} shards', read_shards)
+    assert sorted(read_shards) == sorted(shard_fnames)
+
 ###################
 ## 模型定义
 ###################
@@ -238,22 +395,24 @@ class MaskLM(nn.Module):
                                  nn.LayerNorm(num_hiddens),
                                  nn.Linear(num_hiddens, vocab_size))
 
-    def forward(self, X, pred_positions):
+    # mlm_weights不为None时只计算权重不为0的预测位置，
+    # 输出mlm_Y_hat: (num_preds, vocab_size)，行的顺序与mlm_Y[mlm_weights > 0]一致
+    def forward(self, X, pred_positions, mlm_weights=None):
         # X: (batch_size, seq_len, num_inputs)
         # pred_positions: (batch_size, num_pred_positions)
-        num_pred_positions = pred_positions.shape[1]
-        pred_positions = pred_positions.reshape(-1)
-        batch_size = X.shape[0]
-        batch_idx = torch.arange(0, batch_size)
-        # batch_idx: (batch_size * num_pred_positions)
-        batch_idx = torch.repeat_interleave(batch_idx, num_pred_positions)
-        # 二维索引，batch_idx指定batch_size维度，pred_position指定seq_len维度
-        # masked_X: (batch_size * num_pred_positions, num_inputs)
-        masked_X = X[batch_idx, pred_positions]
-        # masked_X: (batch_size, num_pred_positions, num_inputs)
-        masked_X = masked_X.reshape((batch_size, num_pred_positions, -1))
-        mlm_Y_hat = self.mlp(masked_X)
-        return mlm_Y_hat
+        batch_size, seq_len, num_inputs = X.shape
+        if mlm_weights is None:
+            # 在seq_len维度上按pred_positions取出对应位置的向量，不需要构造batch_idx
+            # masked_X: (batch_size, num_pred_positions, num_inputs)
+            masked_X = X.gather(1, pred_positions.unsqueeze(-1).expand(-1, -1, num_inputs))
+            return self.mlp(masked_X)
+        # flat_positions: (batch_size, num_pred_positions)，X展平为(batch_size * seq_len, num_inputs)后的行号
+        flat_positions = pred_positions + torch.arange(
+            0, batch_size * seq_len, seq_len, device=X.device).unsqueeze(1)
+        # 填充的预测位置不参与输出层的计算，其中词表大小的线性层是预训练中最大的矩阵乘法
+        # masked_X: (num_preds, num_inputs)
+        masked_X = X.reshape(-1, num_inputs).index_select(0, flat_positions[mlm_weights > 0])
+        return self.mlp(masked_X)
 
 mlm = MaskLM(vocab_size, num_hiddens)
 mlm_positions = torch.tensor([[1, 5, 2], [6, 1, 5]])
@@ -267,6 +426,15 @@ mlm_l = loss(mlm_Y_hat.reshape((-1, vocab_size)), mlm_Y.reshape(-1))
 # [6]
 print(mlm_l.shape)
 
+# 只计算权重不为0的预测位置：第二个样本的最后一个预测位置是填充
+mlm_weights = torch.tensor([[1., 1., 1.], [1., 1., 0.]])
+mlm_Y_hat = mlm(encoded_X, mlm_positions, mlm_weights)
+# [5, 10000]
+print(mlm_Y_hat.shape)
+mlm_l = loss(mlm_Y_hat, mlm_Y[mlm_weights > 0])
+# [5]
+print(mlm_l.shape)
+
 # 2）下一句预测
 class NextSentencePred(nn.Module):
     """BERT的下一句预测任务"""
@@ -310,11 +478,12 @@ class BERTModel(nn.Module):
     # tokes: (batch_size, seq_len, num_hiddens)
     # segmets: (batch_size, seq_len, 2)
     # pred_positions: (batch_size, num_pred_positions)
-    def forward(self, tokens, segments, valid_lens=None, pred_positions=None):
+    # mlm_weights: (batch_size, num_pred_positions)，传入时mlm只计算权重不为0的预测位置
+    def forward(self, tokens, segments, valid_lens=None, pred_positions=None, mlm_weights=None):
         # encoded_X: (batch_size, seq_len, num_hiddens)
         encoded_X = self.encoder(tokens, segments, valid_lens)
         if pred_positions is not None:
-            mlm_Y_hat = self.mlm(encoded_X, pred_positions)
+            mlm_Y_hat = self.mlm(encoded_X, pred_positions, mlm_weights)
         else:
             mlm_Y_hat = None
         # 提取encoded_X中每一句句子的第一个字符<cls>，通过hidden层处理后传入nsp模型进行预测
@@ -335,7 +504,14 @@ devices = [common.try_gpu_or_mps()]
 loss = nn.CrossEntropyLoss()
 
 def _get_batch_loss_bert(net, loss, vocab_size, tokens_X, segments_X, valid_lens_x,
-                         pred_positions_X, mlm_weights_X, mlm_Y, nsp_Y):
+                         pred_positions_X, mlm_weights_X, mlm_Y, nsp_Y, sparse_mlm=False):
+    if sparse_mlm:
+        # 只对权重不为0的预测位置计算输出层和损失
+        _, mlm_Y_hat, nsp_Y_hat = net(tokens_X, segments_X, valid_lens_x.reshape(-1),
+                                      pred_positions_X, mlm_weights_X)
+        mlm_l = loss(mlm_Y_hat, mlm_Y[mlm_weights_X > 0])
+        nsp_l = loss(nsp_Y_hat, nsp_Y)
+        return mlm_l, nsp_l, mlm_l + nsp_l
     # 前向传播
     _, mlm_Y_hat, nsp_Y_hat = net(tokens_X, segments_X, valid_lens_x.reshape(-1),
                                   pred_positions_X)
@@ -348,32 +524,32 @@ def _get_batch_loss_bert(net, loss, vocab_size, tokens_X, segments_X, valid_lens
     l = mlm_l + nsp_l
     return mlm_l, nsp_l, l
 
-def train_bert(train_iter, net, loss, vocab_size, devices, num_steps):
+def train_bert(train_iter, net, loss, vocab_size, devices, num_steps, vocab=None,
+               sparse_mlm=False):
     net = nn.DataParallel(net, device_ids=devices).to(devices[0])
     trainer = torch.optim.Adam(net.parameters(), lr=0.01)
     step, timer = 0, d2l.Timer()
     animator = d2l.Animator(xlabel='step', ylabel='loss',
                             xlim=[1, num_steps], legend=['mlm', 'nsp'])
-    metric = d2l.Accumulator(4)
+    # mlm损失，nsp损失，句子对数，步数，有效词元数，包括填充在内的词元数
+    metric = d2l.Accumulator(6)
     num_steps_reached = False
     while step < num_steps and not num_steps_reached:
-        for tokens_X, segments_X, valid_lens_x, pred_positions_X,\
-            mlm_weights_X, mlm_Y, nsp_y in train_iter:
-            tokens_X = tokens_X.to(devices[0])
-            segments_X = segments_X.to(devices[0])
-            valid_lens_x = valid_lens_x.to(devices[0])
-            pred_positions_X = pred_positions_X.to(devices[0])
-            mlm_weights_X = mlm_weights_X.to(devices[0])
-            mlm_Y = mlm_Y.to(devices[0])
-            nsp_y = nsp_y.to(devices[0])
+        for batch in train_iter:
+            batch = [x.to(devices[0]) for x in batch]
+            if len(batch) == 4:
+                # 未遮蔽的批量(tokens, segments, valid_lens, nsp_y)，需要传入vocab，直接在设备上生成遮蔽
+                batch = common.mask_bert_inputs(*batch, vocab)
+            tokens_X, segments_X, valid_lens_x, pred_positions_X,\
+                mlm_weights_X, mlm_Y, nsp_y = batch
             trainer.zero_grad()
             timer.start()
             mlm_l, nsp_l, l = _get_batch_loss_bert(
                 net, loss, vocab_size, tokens_X, segments_X, valid_lens_x,
-            pred_positions_X, mlm_weights_X, mlm_Y, nsp_y)
+            pred_positions_X, mlm_weights_X, mlm_Y, nsp_y, sparse_mlm)
             l.backward()
             trainer.step()
-            metric.add(mlm_l, nsp_l, tokens_X.shape[0], 1)
+            metric.add(mlm_l, nsp_l, tokens_X.shape[0], 1, valid_lens_x.sum(), tokens_X.numel())
             timer.stop()
             animator.add(step + 1,
                          (metric[0] / metric[3], metric[1] / metric[3]))
@@ -384,13 +560,23 @@ def train_bert(train_iter, net, loss, vocab_size, devices, num_steps):
             if step == num_steps:
                 num_steps_reached = True
                 break
-    print(f'{metric[2] / timer.sum():.1f} sentence pairs/sec on '
-          f'{str(devices)}')
+    print(f'{metric[2] / timer.sum():.1f} sentence pairs/sec, '
+          f'{metric[4] / timer.sum():.1f} tokens/sec on {str(devices)}, '
+          f'padding fraction {1 - metric[4] / metric[5]:.3f}')
 
 print('train on ', devices)
 train_bert(train_iter, net, loss, len(vocab), devices, 50)
 plt.show()
 
+# 按长度分桶并动态填充：同一个批量中的句子对长度相近，只填充到批量中最长的序列
+bucket_iter = _get_wiki_iter(train_iter.dataset, batch_size, dynamic_padding=True)
+train_bert(bucket_iter, net, loss, len(vocab), devices, 50)
+plt.show()
+
+# 稀疏的遮蔽语言模型：输出层只计算权重不为0的预测位置
+train_bert(bucket_iter, net, loss, len(vocab), devices, 50, sparse_mlm=True)
+plt.show()
+
 
 ###################
 ## 用BERT表示文本
@@ -421,3 +607,95 @@ encoded_pair = get_bert_encoding(net, tokens_a, tokens_b)
 encoded_pair_cls = encoded_pair[:, 0, :]
 encoded_pair_crane = encoded_pair[:, 2, :]
 print(encoded_pair.shape, encoded_pair_cls.shape, encoded_pair_crane[0][:3])
+
+# 批量计算BERT表示
+class BERTEncodingCache:
+    """批量计算BERT表示，并以LRU缓存已经计算过的句子
+    sentences中的每一项为tokens_a或者(tokens_a, tokens_b)，同一批量只填充到其中最长的序列，
+    只运行编码器，不计算遮蔽语言模型和下一句预测；缓存以(词元元组, output)为键，重复的句子不再计算
+    output='cls'时返回(num_sentences, num_hiddens)的<cls>向量，
+    output='hidden'时返回[(seq_len, num_hiddens)]，每个句子包括<cls>和<sep>在内的所有词元的向量"""
+    def __init__(self, net, vocab, device, batch_size=64, max_cache_size=10000):
+        self.net = net
+        self.vocab = vocab
+        self.device = device
+        self.batch_size = batch_size
+        self.max_cache_size = max_cache_size
+        self._cache = collections.OrderedDict()
+
+    def _key(self, sentence, output):
+        if isinstance(sentence, tuple):
+            return tuple(sentence[0]), tuple(sentence[1]), output
+        return tuple(sentence), None, output
+
+    def _encode(self, keys):
+        # 先按长度排序，长度相近的句子放在同一个批量中，减少填充
+        examples = [get_tokens_and_segments(list(tokens_a),
+                                            None if tokens_b is None else list(tokens_b))
+                    for tokens_a, tokens_b, _ in keys]
+        order = sorted(range(len(keys)), key=lambda i: len(examples[i][0]))
+        encodings = [None] * len(keys)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            max_len = max(len(examples[i][0]) for i in batch)
+            token_ids = torch.full((len(batch), max_len), self.vocab['<pad>'], dtype=torch.long)
+            segments = torch.zeros((len(batch), max_len), dtype=torch.long)
+            valid_lens = torch.tensor([len(examples[i][0]) for i in batch])
+            for row, i in enumerate(batch):
+                tokens, segment = examples[i]
+                token_ids[row, :len(tokens)] = torch.tensor(self.vocab[tokens])
+                segments[row, :len(segment)] = torch.tensor(segment)
+            # encoded_X: (batch_size, max_len, num_hiddens)
+            encoded_X = self.net.encoder(token_ids.to(self.device), segments.to(self.device),
+                                         valid_lens.to(self.device))
+            # 缓存的是复制出来的张量，切片视图会让整个批量的encoded_X一直留在内存中
+            for row, i in enumerate(batch):
+                if keys[i][2] == 'cls':
+                    encodings[i] = encoded_X[row, 0].detach().clone()
+                else:
+                    encodings[i] = encoded_X[row, :valid_lens[row]].detach().clone()
+        return encodings
+
+    def encode(self, sentences, output='cls'):
+        assert output in ('cls', 'hidden'), 'Unknown output type: ' + output
+        keys = [self._key(sentence, output) for sentence in sentences]
+        # 去掉重复的句子以及已经缓存的句子，剩下的一起批量计算
+        missing = [key for key in dict.fromkeys(keys) if key not in self._cache]
+        if missing:
+            training = self.net.training
+            self.net.eval()
+            with torch.inference_mode():
+                encodings = self._encode(missing)
+            self.net.train(training)
+            computed = dict(zip(missing, encodings))
+        else:
+            computed = {}
+        results = []
+        for key in keys:
+            if key in computed:
+                encoding = computed[key]
+            else:
+                encoding = self._cache[key]
+                self._cache.move_to_end(key)
+            results.append(encoding)
+        for key, encoding in computed.items():
+            self._cache[key] = encoding
+            if len(self._cache) > self.max_cache_size:
+                # 淘汰最久没有用到的句子
+                self._cache.popitem(last=False)
+        if output == 'cls':
+            return torch.stack(results) if results else torch.empty(0)
+        return results
+
+encoder_cache = BERTEncodingCache(net, vocab, devices[0])
+sentences = [['a', 'crane', 'is', 'flying'],
+             (['a', 'crane', 'driver', 'came'], ['he', 'just', 'left']),
+             ['a', 'crane', 'is', 'flying']]
+# encoded_cls: (3, 128)，重复的句子只计算一次
+encoded_cls = encoder_cache.encode(sentences)
+# encoded_hidden: [(6, 128), (10, 128), (6, 128)]
+encoded_hidden = encoder_cache.encode(sentences, output='hidden')
+print(encoded_cls.shape, [x.shape for x in encoded_hidden], encoded_hidden[1][2][:3])
+# 每个缓存的表示只占用与自身大小相同的存储
+assert all(x.untyped_storage().nbytes() == x.numel() * x.element_size()
+           for x in encoder_cache._cache.values())
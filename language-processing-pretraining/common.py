@@ -80,12 +80,127 @@ class Vocab:
         return self._token_freqs
 
 def count_corpus(tokens):
+    if isinstance(tokens, collections.Counter):
+        # 已经统计好的词频，例如流式读取语料时逐行累加的结果
+        return tokens
     if len(tokens) == 0 or isinstance(tokens[0], list):
         # 将词元列表展平成一个列表
         tokens = [token for line in tokens for token in line]
     return collections.Counter(tokens)
 
 
+# 遮蔽语言模型任务的数据
+def mask_mlm_tokens(token_ids, valid_lens, vocab, max_num_mlm_preds=None, generator=None):
+    """在已经转换为索引并填充好的词元矩阵上，为每一行同时生成遮蔽语言模型的数据
+    token_ids: (batch_size, max_len)，valid_lens: (batch_size)，可以在任意设备上计算
+    每行在<cls>、<sep>和填充以外的位置中随机选取15%(至少1个)作为预测位置，
+    其中80%替换为<mask>，10%替换为随机词元，10%保持不变
+    返回(mlm_token_ids, pred_positions, mlm_weights, mlm_labels)，
+    后三者为(batch_size, max_num_mlm_preds)，预测位置按从小到大排列，填充的预测位置权重为0"""
+    batch_size, max_len = token_ids.shape
+    device = token_ids.device
+    if max_num_mlm_preds is None:
+        max_num_mlm_preds = round(max_len * 0.15)
+    positions = torch.arange(max_len, device=device)
+    # candidates: (batch_size, max_len)，可以被遮蔽的位置
+    candidates = ((positions < valid_lens.reshape(-1, 1)) &
+                  (token_ids != vocab['<cls>']) & (token_ids != vocab['<sep>']))
+    # num_mlm_preds: (batch_size)，与round一样四舍六入五成双
+    num_mlm_preds = torch.round(valid_lens.reshape(-1).float() * 0.15).long().clamp(min=1)
+    num_mlm_preds = torch.minimum(num_mlm_preds, candidates.sum(dim=1)).clamp(max=max_num_mlm_preds)
+    # 随机打乱候选位置：每个位置取一个随机数，非候选位置为2，取最小的num_mlm_preds个
+    rand = torch.rand(token_ids.shape, device=device, generator=generator)
+    _, pred_positions = rand.masked_fill(~candidates, 2).topk(
+        max_num_mlm_preds, dim=1, largest=False)
+    # mlm_weights: (batch_size, max_num_mlm_preds)
+    mlm_weights = torch.arange(max_num_mlm_preds, device=device) < num_mlm_preds.unsqueeze(1)
+    # 不需要的预测位置先设为max_len，排序后排在最后
+    pred_positions = pred_positions.masked_fill(~mlm_weights, max_len).sort(dim=1).values
+    # selected: (batch_size, max_len)，多出的一列用来接收填充的预测位置
+    selected = torch.zeros((batch_size, max_len + 1), dtype=torch.bool, device=device)
+    selected = selected.scatter_(1, pred_positions, True)[:, :max_len]
+    pred_positions = pred_positions.masked_fill(~mlm_weights, 0)
+    mlm_labels = token_ids.gather(1, pred_positions).masked_fill(~mlm_weights, 0)
+    # 80%替换为<mask>，10%替换为随机词元，10%保持原词
+    rand = torch.rand(token_ids.shape, device=device, generator=generator)
+    random_token_ids = torch.randint(len(vocab), token_ids.shape, device=device,
+                                     generator=generator, dtype=token_ids.dtype)
+    mlm_token_ids = torch.where(selected & (rand < 0.8), vocab['<mask>'], token_ids)
+    mlm_token_ids = torch.where(selected & (rand >= 0.9), random_token_ids, mlm_token_ids)
+    return mlm_token_ids, pred_positions, mlm_weights.float(), mlm_labels
+
+
+def mask_bert_inputs(token_ids, segments, valid_lens, nsp_labels, vocab, max_num_mlm_preds=None):
+    """为一个未遮蔽的批量生成遮蔽语言模型的数据，返回与预先遮蔽的数据集相同的7元组
+    (token_ids, segments, valid_lens, pred_positions, mlm_weights, mlm_labels, nsp_labels)"""
+    mlm_token_ids, pred_positions, mlm_weights, mlm_labels = mask_mlm_tokens(
+        token_ids, valid_lens, vocab, max_num_mlm_preds)
+    return (mlm_token_ids, segments, valid_lens, pred_positions, mlm_weights, mlm_labels,
+            nsp_labels)
+
+class MLMCollate:
+    """DataLoader的collate_fn：把样本(token_ids, segments, valid_len, nsp_label)拼接成批量，
+    再在整个批量上动态生成遮蔽语言模型的数据，每个epoch遮蔽的位置都不同
+    dynamic_padding为True时先截断到批量中最长的序列(见pad_to_longest)再遮蔽"""
+    def __init__(self, vocab, max_num_mlm_preds=None, dynamic_padding=False):
+        self.vocab = vocab
+        self.max_num_mlm_preds = max_num_mlm_preds
+        self.dynamic_padding = dynamic_padding
+
+    def __call__(self, examples):
+        # examples为样本列表时先拼接；数据集已经按批量切片时(batch_size=None)直接是一个批量
+        if self.dynamic_padding:
+            examples = pad_to_longest(examples)
+        elif isinstance(examples, list):
+            examples = torch.utils.data.default_collate(examples)
+        return mask_bert_inputs(*examples, self.vocab, self.max_num_mlm_preds)
+
+# 动态填充
+def pad_to_longest(batch):
+    """DataLoader的collate_fn：数据集中的序列都填充到了max_len，这里把批量截断到其中最长的有效长度，
+    编码器中的注意力计算不再浪费在批量中都是<pad>的位置上
+    支持(token_ids, segments, valid_lens, ...)和([token_ids, segments, valid_lens], labels)两种批量，
+    batch为样本列表时先拼接"""
+    if isinstance(batch, list):
+        batch = torch.utils.data.default_collate(batch)
+    if isinstance(batch[0], (list, tuple)):
+        return [*pad_to_longest(tuple(batch[0]))], batch[1]
+    token_ids, segments, valid_lens = batch[:3]
+    max_valid_len = int(valid_lens.max())
+    return (token_ids[:, :max_valid_len], segments[:, :max_valid_len], valid_lens) + tuple(batch[3:])
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """按长度分桶的批量采样器
+    打乱所有样本后，每bucket_size个样本按长度排序再切分成批量，最后打乱批量的顺序，
+    同一个批量中的序列长度相近，配合pad_to_longest可以大幅减少填充"""
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, num_batches_per_bucket=100):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        # 桶的大小是batch_size的整数倍，只有最后一个桶会产生不满的批量
+        self.bucket_size = batch_size * num_batches_per_bucket
+
+    def __iter__(self):
+        num_examples = len(self.lengths)
+        indices = torch.randperm(num_examples) if self.shuffle else torch.arange(num_examples)
+        batches = []
+        for start in range(0, num_examples, self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[torch.sort(self.lengths[bucket], stable=True).indices]
+            batches.extend(bucket.split(self.batch_size))
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
 def sequence_mask(X, valid_len, value=0):
     # X: (batch_num, maxlen)
     # valid_len: (batch_num)
@@ -101,7 +216,7 @@ def sequence_mask(X, valid_len, value=0):
 
 def masked_softmax(X, valid_lens):
     if valid_lens is None:
-        return nn.functional.softmax(X, dim=1)
+        return nn.functional.softmax(X, dim=-1)
     else:
         shape = X.shape
         # 当X形如(batch_size, num_seq, num_word), valid_lens形如(batch_size)时，
@@ -117,39 +232,85 @@ def masked_softmax(X, valid_lens):
         return nn.functional.softmax(X.reshape(shape), dim=-1)
 
 
+def valid_lens_mask(valid_lens, num_keys):
+    """由有效长度构造可广播的布尔掩码，True表示对应的键参与注意力"""
+    # valid_lens: (batch_size) or (batch_size, num_queries)
+    # mask: (batch_size, num_keys) or (batch_size, num_queries, num_keys)
+    mask = torch.arange(num_keys, device=valid_lens.device) < valid_lens.unsqueeze(-1)
+    if valid_lens.dim() == 1:
+        # mask: (batch_size, 1, num_keys)，沿查询维度广播
+        mask = mask.unsqueeze(1)
+    return mask
+
 # 缩放点积注意力
 class DotProductAttention(nn.Module):
-     def __init__(self, dropout, **kwargs):
-          super(DotProductAttention, self).__init__(**kwargs)
-          self.dropout = nn.Dropout(dropout)
-
-     # queries: (batch_size, num_queries, d)
-     # keys: (batch_size, num_pair, d)
-     # values: (batch_size, num_pair, value_size)
-     # valid_lens: (batch_size)
-     def forward(self, queries, keys, values, valid_lens=None):
-          d = queries.shape[-1]
-          # scores: (batch_size, num_queries, num_pair)
-          scores = torch.bmm(queries, keys.transpose(1, 2)) / math.sqrt(d)
-          # attention_weights: (batch_size, num_queries, num_pair)
-          self.attention_weights = masked_softmax(scores, valid_lens)
-          # output: (batch_size, num_queries, value_size)
-          return torch.bmm(self.dropout(self.attention_weights), values)
+    """缩放点积注意力
+
+    backend='sdpa'时调用PyTorch融合的scaled_dot_product_attention，由PyTorch在
+    flash/memory-efficient/math等实现中选择可用的一个，此时不计算注意力权重；
+    backend='math'或PyTorch版本不支持时，按显式公式计算并保存attention_weights。
+    """
+    def __init__(self, dropout, backend='sdpa', **kwargs):
+        super(DotProductAttention, self).__init__(**kwargs)
+        self.dropout = nn.Dropout(dropout)
+        if not hasattr(nn.functional, 'scaled_dot_product_attention'):
+            backend = 'math'
+        self.backend = backend
+        self.attention_weights = None
+
+    # queries: (..., num_queries, d)
+    # keys: (..., num_keys, d)
+    # values: (..., num_keys, value_dim)
+    # valid_lens: (batch_size) or (batch_size, num_queries)，仅用于3维输入
+    # mask: 可广播到(..., num_queries, num_keys)的布尔掩码，优先于valid_lens
+    def forward(self, queries, keys, values, valid_lens=None, mask=None):
+        if mask is None and valid_lens is not None:
+            mask = valid_lens_mask(valid_lens, keys.shape[-2])
+        if self.backend == 'sdpa':
+            self.attention_weights = None
+            if mask is None:
+                return nn.functional.scaled_dot_product_attention(
+                    queries, keys, values, dropout_p=self.dropout.p if self.training else 0.0)
+            # 所有键都被遮蔽的行(valid_len为0)在SDPA中输出NaN，而显式计算中各个键的分数都是-1e6，
+            # 权重是均匀的，输出为values的平均值；先让这些行看到所有键，再用平均值替换它们的输出
+            # empty: (..., num_queries, 1)
+            empty = ~mask.any(dim=-1, keepdim=True)
+            output = nn.functional.scaled_dot_product_attention(
+                queries, keys, values, attn_mask=mask | empty,
+                dropout_p=self.dropout.p if self.training else 0.0)
+            return torch.where(empty, values.mean(dim=-2, keepdim=True), output)
+        d = queries.shape[-1]
+        # scores: (..., num_queries, num_keys)
+        scores = torch.matmul(queries, keys.transpose(-2, -1)) / math.sqrt(d)
+        if mask is not None:
+            scores = scores.masked_fill(~mask, -1e6)
+        weights = nn.functional.softmax(scores, dim=-1)
+        # attention_weights: (batch_size * num_heads, num_queries, num_keys)，与多头注意力的旧布局一致
+        self.attention_weights = weights.detach().flatten(0, -3)
+        # output: (..., num_queries, value_dim)
+        return torch.matmul(self.dropout(weights), values)
 
 # X: (batch_size, num_pair, num_hiddens)
 def transpose_qkv(X, num_heads):
     """为了多注意力头的并行计算而变换形状"""
     # X: (batch_size, num_pair, num_head, num_hiddens / num_head)
     X = X.reshape(X.shape[0], X.shape[1], num_heads, -1)
-    # X: (batch_size, num_head, num_pair, num_hiddens / num_head)
-    X = X.permute(0, 2, 1, 3)
-    # X: (batch_size * num_head, num_pair, num_hiddens / num_head)
-    return X.reshape(-1, X.shape[2], X.shape[3])
-
-# X: (batch_szie * num_head, num_pair, num_hiddens / num_head)
+    # X: (batch_size, num_head, num_pair, num_hiddens / num_head)，只是改变步幅的视图，不拷贝
+    return X.transpose(1, 2)
+
+# X: (batch_size, num_pair, num * num_hiddens)
+def transpose_packed_qkv(X, num, num_heads):
+    """把沿最后一维打包在一起的num个投影一次性变换为多头形状"""
+    batch_size, num_pair = X.shape[0], X.shape[1]
+    # X: (num, batch_size, num_head, num_pair, num_hiddens / num_head)，只是改变步幅的视图，不拷贝
+    X = X.view(batch_size, num_pair, num, num_heads, -1).permute(2, 0, 3, 1, 4)
+    # 每一项: (batch_size, num_head, num_pair, num_hiddens / num_head)
+    return X.unbind(0)
+
+# X: (batch_size, num_head, num_pair, num_hiddens / num_head)
 def transpose_output(X, num_heads):
-    X = X.reshape(-1, num_heads, X.shape[1], X.shape[2])
-    X = X.permute(0, 2, 1, 3)
+    # X: (batch_size, num_pair, num_head, num_hiddens / num_head)
+    X = X.transpose(1, 2)
     # X: (batch_size, num_pair, num_hiddens)
     return X.reshape(X.shape[0], X.shape[1], -1)
 
@@ -159,31 +320,70 @@ class MultiHeadAttention(nn.Module):
                  dropout, bias=False, **kwargs):
         super(MultiHeadAttention, self).__init__(**kwargs)
         self.num_heads = num_heads
+        self.num_hiddens = num_hiddens
         self.attention = DotProductAttention(dropout)
-        self.W_q = nn.Linear(query_size, num_hiddens, bias=bias)
-        self.W_k = nn.Linear(key_size, num_hiddens, bias=bias)
-        self.W_v = nn.Linear(value_size, num_hiddens, bias=bias)
+        # 查询、键、值的输入维度相同时，把W_q、W_k、W_v按行拼成一个权重W_qkv，
+        # 自注意力只需一次矩阵乘法；输入维度不同时仍使用三个独立的投影
+        self.fused = query_size == key_size == value_size
+        if self.fused:
+            self.W_qkv = nn.Linear(query_size, 3 * num_hiddens, bias=bias)
+        else:
+            self.W_q = nn.Linear(query_size, num_hiddens, bias=bias)
+            self.W_k = nn.Linear(key_size, num_hiddens, bias=bias)
+            self.W_v = nn.Linear(value_size, num_hiddens, bias=bias)
         self.W_o = nn.Linear(num_hiddens, num_hiddens, bias=bias)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 兼容W_q、W_k、W_v分开保存的参数（如预训练好的BERT），按q、k、v的顺序拼成W_qkv
+        if self.fused:
+            for name in ('weight', 'bias'):
+                keys = [f'{prefix}W_{c}.{name}' for c in 'qkv']
+                if all(key in state_dict for key in keys):
+                    state_dict[f'{prefix}W_qkv.{name}'] = torch.cat(
+                        [state_dict.pop(key) for key in keys], dim=0)
+        super(MultiHeadAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _fused_linear(self, X, start, num):
+        """只用W_qkv中第start个起的num个投影（按q、k、v排列）对X做变换"""
+        h = self.num_hiddens
+        weight, bias = self.W_qkv.weight, self.W_qkv.bias
+        return nn.functional.linear(X, weight[start * h:(start + num) * h],
+                                    None if bias is None else bias[start * h:(start + num) * h])
+
+    # 返回的queries, keys, values: (batch_size, num_head, num_pair, num_hiddens / num_head)
+    def _project(self, queries, keys, values):
+        if not self.fused:
+            return (transpose_qkv(self.W_q(queries), self.num_heads),
+                    transpose_qkv(self.W_k(keys), self.num_heads),
+                    transpose_qkv(self.W_v(values), self.num_heads))
+        if queries is keys and keys is values:
+            # 自注意力：一次矩阵乘法同时得到q、k、v
+            return transpose_packed_qkv(self.W_qkv(queries), 3, self.num_heads)
+        queries, = transpose_packed_qkv(self._fused_linear(queries, 0, 1), 1, self.num_heads)
+        if keys is values:
+            # 编码器-解码器注意力：键和值来自同一个张量，一次矩阵乘法得到k、v
+            keys, values = transpose_packed_qkv(self._fused_linear(keys, 1, 2), 2, self.num_heads)
+        else:
+            keys, = transpose_packed_qkv(self._fused_linear(keys, 1, 1), 1, self.num_heads)
+            values, = transpose_packed_qkv(self._fused_linear(values, 2, 1), 1, self.num_heads)
+        return queries, keys, values
+
     # queries: (batch_size, num_pair, query_size)
     # keys: (batch_size, num_pair, key_size)
     # values: (batch_size, num_pair, num_hiddens)
     # valid_lens: (batch_size) or (batch_size, num_query)
     def forward(self, queries, keys, values, valid_lens):
-        # queries, keys, value: (batch_size * num_head, num_pair, num_hiddens / num_head)
-        queries = transpose_qkv(self.W_q(queries), self.num_heads)
-        keys = transpose_qkv(self.W_k(keys), self.num_heads)
-        values = transpose_qkv(self.W_v(values), self.num_heads)
-
-        if valid_lens is not None:
-            # 在轴0，将每一项复制num_heads次
-            valid_lens = torch.repeat_interleave(valid_lens, repeats=self.num_heads, dim=0)
-
-        # output: (batch_num * num_head, num_queries, num_hiddens / num_head)
-        output = self.attention(queries, keys, values, valid_lens)
-        # output_concat: (batch_num, num_queries, num_hiddens)
+        # queries: (batch_size, num_head, query_seq_len, num_hiddens / num_head)
+        # keys, values: (batch_size, num_head, key_seq_len, num_hiddens / num_head)
+        queries, keys, values = self._project(queries, keys, values)
+        # 由valid_lens构造一次掩码，在头的维度上广播，不必将valid_lens复制num_heads次
+        # mask: (batch_size, 1, 1, key_seq_len) or (batch_size, 1, num_query, key_seq_len)
+        mask = None if valid_lens is None else valid_lens_mask(valid_lens, keys.shape[2]).unsqueeze(1)
+        # output: (batch_size, num_head, query_seq_len, num_hiddens / num_head)
+        output = self.attention(queries, keys, values, mask=mask)
+        # output_concat: (batch_size, query_seq_len, num_hiddens)
         output_concat = transpose_output(output, self.num_heads)
-        # (batch_name, num_queries, num_hiddens)
+        # (batch_size, query_seq_len, num_hiddens)
         return self.W_o(output_concat)
 
 class AddNorm(nn.Module):
@@ -264,22 +464,24 @@ class MaskLM(nn.Module):
                                  nn.LayerNorm(num_hiddens),
                                  nn.Linear(num_hiddens, vocab_size))
 
-    def forward(self, X, pred_positions):
+    # mlm_weights不为None时只计算权重不为0的预测位置，
+    # 输出mlm_Y_hat: (num_preds, vocab_size)，行的顺序与mlm_Y[mlm_weights > 0]一致
+    def forward(self, X, pred_positions, mlm_weights=None):
         # X: (batch_size, seq_len, num_inputs)
         # pred_positions: (batch_size, num_pred_positions)
-        num_pred_positions = pred_positions.shape[1]
-        pred_positions = pred_positions.reshape(-1)
-        batch_size = X.shape[0]
-        batch_idx = torch.arange(0, batch_size)
-        # batch_idx: (batch_size * num_pred_positions)
-        batch_idx = torch.repeat_interleave(batch_idx, num_pred_positions)
-        # 二维索引，batch_idx指定batch_size维度，pred_position指定seq_len维度
-        # masked_X: (batch_size * num_pred_positions, num_inputs)
-        masked_X = X[batch_idx, pred_positions]
-        # masked_X: (batch_size, num_pred_positions, num_inputs)
-        masked_X = masked_X.reshape((batch_size, num_pred_positions, -1))
-        mlm_Y_hat = self.mlp(masked_X)
-        return mlm_Y_hat
+        batch_size, seq_len, num_inputs = X.shape
+        if mlm_weights is None:
+            # 在seq_len维度上按pred_positions取出对应位置的向量，不需要构造batch_idx
+            # masked_X: (batch_size, num_pred_positions, num_inputs)
+            masked_X = X.gather(1, pred_positions.unsqueeze(-1).expand(-1, -1, num_inputs))
+            return self.mlp(masked_X)
+        # flat_positions: (batch_size, num_pred_positions)，X展平为(batch_size * seq_len, num_inputs)后的行号
+        flat_positions = pred_positions + torch.arange(
+            0, batch_size * seq_len, seq_len, device=X.device).unsqueeze(1)
+        # 填充的预测位置不参与输出层的计算，其中词表大小的线性层是预训练中最大的矩阵乘法
+        # masked_X: (num_preds, num_inputs)
+        masked_X = X.reshape(-1, num_inputs).index_select(0, flat_positions[mlm_weights > 0])
+        return self.mlp(masked_X)
 
 class NextSentencePred(nn.Module):
     """BERT的下一句预测任务"""
@@ -309,11 +511,12 @@ class BERTModel(nn.Module):
     # tokes: (batch_size, seq_len, num_hiddens)
     # segmets: (batch_size, seq_len, 2)
     # pred_positions: (batch_size, num_pred_positions)
-    def forward(self, tokens, segments, valid_lens=None, pred_positions=None):
+    # mlm_weights: (batch_size, num_pred_positions)，传入时mlm只计算权重不为0的预测位置
+    def forward(self, tokens, segments, valid_lens=None, pred_positions=None, mlm_weights=None):
         # encoded_X: (batch_size, seq_len, num_hiddens)
         encoded_X = self.encoder(tokens, segments, valid_lens)
         if pred_positions is not None:
-            mlm_Y_hat = self.mlm(encoded_X, pred_positions)
+            mlm_Y_hat = self.mlm(encoded_X, pred_positions, mlm_weights)
         else:
             mlm_Y_hat = None
         # 提取encoded_X中每一句句子的第一个字符<cls>，通过hidden层处理后传入nsp模型进行预测
@@ -334,7 +537,7 @@ def evaluate_accuracy_gpu(net, data_iter, device=None):
     metric = d2l.Accumulator(2)
     with torch.no_grad():
         for X, y in data_iter:
-            if isinstance(X, list):
+            if isinstance(X, (list, tuple)):
                 X = [x.to(device) for x in X]
             else:
                 X = X.to(device)
@@ -346,7 +549,7 @@ def train_batch_ch13(net, X, y, loss, trainer, devices):
     if len(devices) != 0:
         # 在单/多GPU上训练时，把数据先copy到第一个GPU设备；
         # 多GPU训练中，框架会负责将数据分发到其他参与并行计算的GPU设备上
-        if isinstance(X, list):
+        if isinstance(X, (list, tuple)):
             # 微调BERT中所需
             X = [x.to(devices[0]) for x in X]
         else:
@@ -1,5 +1,7 @@
 import common
+import hashlib
 import json
+import multiprocessing
 import os
 import matplotlib.pyplot as plt
 import torch
@@ -34,60 +36,102 @@ bert, vocab = load_pretrained_model(
 print('bert model loaded')
 
 # 微调BERT的数据集
+def _truncate_pair_of_tokens(p_tokens, h_tokens, max_len):
+    # 为BERT输入中的'<CLS>'、'<SEP>'和'<SEP>'词元保留位置
+    while len(p_tokens) + len(h_tokens) > max_len - 3:
+        if len(p_tokens) > len(h_tokens):
+            p_tokens.pop()
+        else:
+            h_tokens.pop()
+
+def _encode_pair(premise_hypothesis_tokens, vocab, max_len):
+    p_tokens, h_tokens = premise_hypothesis_tokens
+    _truncate_pair_of_tokens(p_tokens, h_tokens, max_len)
+    tokens, segments = common.get_tokens_and_segments(p_tokens, h_tokens)
+    token_ids = vocab[tokens] + [vocab['<pad>']] * (max_len - len(tokens))
+    segments = segments + [0] * (max_len - len(segments))
+    valid_len = len(tokens)
+    return token_ids, segments, valid_len
+
+def _pack(out):
+    # out: [(token_ids, segments, valid_len)]
+    return (torch.tensor([token_ids for token_ids, _, _ in out], dtype=torch.long),
+            torch.tensor([segments for _, segments, _ in out], dtype=torch.long),
+            torch.tensor([valid_len for _, _, valid_len in out]))
+
+# 多进程预处理的子进程函数，只使用词表和max_len，不需要序列化整个数据集对象
+def _mp_init(vocab, max_len, all_premise_hypothesis_tokens):
+    global _mp_shared
+    _mp_shared = (vocab, max_len, all_premise_hypothesis_tokens)
+
+def _mp_chunk(chunk):
+    vocab, max_len, all_premise_hypothesis_tokens = _mp_shared
+    start, end = chunk
+    return _pack([_encode_pair(premise_hypothesis_tokens, vocab, max_len)
+                  for premise_hypothesis_tokens in all_premise_hypothesis_tokens[start:end]])
+
 class SNLIBERTDataset(torch.utils.data.Dataset):
     # dataset: (premises, hypothesises, labels)
     # label取值: 0-'entailment', 1-'contradiction', 2-'neutral'
-    def __init__(self, dataset, max_len, vocab=None):
-        premise_hypothesis_tokens = [common.tokenize([s.lower() for s in sentences])
-                for sentences in dataset[:2]]
-        # all_premise_hypothesis_tokens: [(p_tokens, h_tokens)]
-        all_premise_hypothesis_tokens = \
-            [[p_tokens, h_tokens] for p_tokens, h_tokens in zip(*premise_hypothesis_tokens)]
-        self.labels = torch.tensor(dataset[2])
+    # num_workers: 预处理使用的进程数，默认为0，在当前进程中串行处理。
+    #     大于0时使用多进程，spawn/forkserver启动方式下子进程会重新导入主模块，
+    #     调用的脚本需要把构造数据集的代码放在 if __name__ == '__main__': 之下
+    # cache_dir: 不为None时把预处理的结果缓存到该目录，数据集、max_len和词表都相同时直接读取缓存
+    def __init__(self, dataset, max_len, vocab=None, num_workers=0, cache_dir=None):
         self.vocab = vocab
         self.max_len = max_len
-        (self.all_token_ids, self.all_segments,
-         self.valid_lens) = self._preprocess(all_premise_hypothesis_tokens)
+        cache_fname = None
+        if cache_dir is not None:
+            cache_fname = os.path.join(cache_dir, f'snli_bert_{self._cache_key(dataset)}.pt')
+        if cache_fname is not None and os.path.exists(cache_fname):
+            (self.all_token_ids, self.all_segments,
+             self.valid_lens) = torch.load(cache_fname)
+        else:
+            premise_hypothesis_tokens = [common.tokenize([s.lower() for s in sentences])
+                    for sentences in dataset[:2]]
+            # all_premise_hypothesis_tokens: [(p_tokens, h_tokens)]
+            all_premise_hypothesis_tokens = \
+                [[p_tokens, h_tokens] for p_tokens, h_tokens in zip(*premise_hypothesis_tokens)]
+            (self.all_token_ids, self.all_segments,
+             self.valid_lens) = self._preprocess(all_premise_hypothesis_tokens, num_workers)
+            if cache_fname is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                # 先写临时文件再重命名，写入过程中被打断时不会留下不完整的缓存
+                torch.save((self.all_token_ids, self.all_segments, self.valid_lens),
+                           cache_fname + '.tmp')
+                os.replace(cache_fname + '.tmp', cache_fname)
+        self.labels = torch.tensor(dataset[2])
         print('read ' + str(len(self.all_token_ids)) + ' examples')
         print(self.all_token_ids[0])
         print(self.all_segments[0])
         print(self.valid_lens[0])
 
-    def _preprocess(self, all_premise_hypothesis_tokens):
-        all_token_ids, all_segments, all_valid_len = [], [], []
-        for p_tokens, h_tokens in all_premise_hypothesis_tokens:
-            self._truncate_pair_of_tokens(p_tokens, h_tokens)
-            tokens, segments = common.get_tokens_and_segments(p_tokens, h_tokens)
-            token_ids = (self.vocab[tokens] + [self.vocab['<pad>']]
-                         * (self.max_len - len(tokens)))
-            segments = segments + [0] * (self.max_len - len(segments))
-            valid_len = len(tokens)
-            all_token_ids.append(token_ids)
-            all_segments.append(segments)
-            all_valid_len.append(valid_len)
-        return (torch.tensor(all_token_ids, dtype=torch.long),
-                torch.tensor(all_segments, dtype=torch.long),
-                torch.tensor(all_valid_len))
-
-    def _mp_worker(self, premise_hypothesis_tokens):
-        p_tokens, h_tokens = premise_hypothesis_tokens
-        self._truncate_pair_of_tokens(p_tokens, h_tokens)
-        tokens, segments = common.get_tokens_and_segments(p_tokens, h_tokens)
-        token_ids = (self.vocab[tokens] + [self.vocab['<pad>']]
-                     * (self.max_len - len(tokens)))
-        segments = segments + [0] * (self.max_len - len(segments))
-        valid_len = len(tokens)
-        return token_ids, segments, valid_len
-
-    def _truncate_pair_of_tokens(self, p_tokens, h_tokens):
-        # 为BERT输入中的'<CLS>'、'<SEP>'和'<SEP>'词元保留位置
-        while len(p_tokens) + len(h_tokens) > self.max_len - 3:
-            if len(p_tokens) > len(h_tokens):
-                p_tokens.pop()
-            else:
-                h_tokens.pop()
+    def _cache_key(self, dataset):
+        # 缓存的键由数据集的哈希、max_len和词表的哈希组成
+        data_hash, vocab_hash = hashlib.sha1(), hashlib.sha1()
+        for sentences in dataset[:2]:
+            data_hash.update('\n'.join(sentences).encode())
+        vocab_hash.update('\n'.join(self.vocab.idx_to_token).encode())
+        return f'{data_hash.hexdigest()[:12]}_{self.max_len}_{vocab_hash.hexdigest()[:12]}'
+
+    def _preprocess(self, all_premise_hypothesis_tokens, num_workers=0):
+        num_examples = len(all_premise_hypothesis_tokens)
+        if num_workers == 0:
+            return _pack([_encode_pair(premise_hypothesis_tokens, self.vocab, self.max_len)
+                          for premise_hypothesis_tokens in all_premise_hypothesis_tokens])
+        # 子进程只在启动时接收一次词表和所有词元，之后的任务只传递分块的范围，
+        # 每个分块在子进程中直接打包成张量返回
+        chunksize = max(1, (num_examples + num_workers * 4 - 1) // (num_workers * 4))
+        chunks = [(i, min(i + chunksize, num_examples)) for i in range(0, num_examples, chunksize)]
+        with multiprocessing.Pool(num_workers, initializer=_mp_init,
+                                  initargs=(self.vocab, self.max_len, all_premise_hypothesis_tokens)) as pool:
+            out = pool.map(_mp_chunk, chunks)
+        return tuple(torch.cat(tensors) for tensors in zip(*out))
 
     def __getitem__(self, idx):
+        # idx为一个批量的索引列表时(见BucketBatchSampler)，每个字段只需一次索引
+        if isinstance(idx, list):
+            idx = torch.tensor(idx)
         return (self.all_token_ids[idx], self.all_segments[idx],
                 self.valid_lens[idx]), self.labels[idx]
 
@@ -96,11 +140,23 @@ class SNLIBERTDataset(torch.utils.data.Dataset):
 
 batch_size, max_len = 512, 128
 data_dir = d2l.download_extract('SNLI')
-train_set = SNLIBERTDataset(d2l.read_snli(data_dir, True), max_len, vocab)
-test_set = SNLIBERTDataset(d2l.read_snli(data_dir, False), max_len, vocab)
+# 把预处理的结果缓存到数据集目录下，之后再次微调时直接读取
+cache_dir = os.path.join(data_dir, 'bert_cache')
+train_set = SNLIBERTDataset(d2l.read_snli(data_dir, True), max_len, vocab, cache_dir=cache_dir)
+test_set = SNLIBERTDataset(d2l.read_snli(data_dir, False), max_len, vocab, cache_dir=cache_dir)
 train_iter = torch.utils.data.DataLoader(train_set, batch_size, shuffle=True)
 test_iter = torch.utils.data.DataLoader(test_set, batch_size)
 
+# 按有效长度分桶，并把每个批量截断到其中最长的序列，train_ch13不需要任何修改
+# batch_size=None时数据集直接按批量切片，collate_fn只负责截断
+bucket_train_iter = torch.utils.data.DataLoader(
+    train_set, batch_size=None, sampler=common.BucketBatchSampler(train_set.valid_lens, batch_size),
+    collate_fn=common.pad_to_longest)
+bucket_test_iter = torch.utils.data.DataLoader(
+    test_set, batch_size=None,
+    sampler=common.BucketBatchSampler(test_set.valid_lens, batch_size, shuffle=False),
+    collate_fn=common.pad_to_longest)
+
 
 # 微调BERT
 class BERTClassifier(nn.Module):
@@ -115,9 +171,31 @@ class BERTClassifier(nn.Module):
         encoded_X = self.encoder(tokens_X, segments_X, valid_lens_x)
         return self.output(self.hidden(encoded_X[:, 0, :]))
 
+def benchmark_encoder(net, data_iter, device, num_batches=20):
+    """统计编码器前向计算每秒处理的有效词元数，以及批量中填充词元所占的比例"""
+    net = net.to(device)
+    net.eval()
+    timer, metric = d2l.Timer(), d2l.Accumulator(2)
+    with torch.no_grad():
+        for i, ((tokens_X, segments_X, valid_lens_x), _) in enumerate(data_iter):
+            if i == num_batches:
+                break
+            tokens_X, segments_X, valid_lens_x = [x.to(device) for x in (tokens_X, segments_X, valid_lens_x)]
+            timer.start()
+            net([tokens_X, segments_X, valid_lens_x]).sum().item()
+            timer.stop()
+            metric.add(valid_lens_x.sum(), tokens_X.numel())
+    print(f'{metric[0] / timer.sum():.1f} tokens/sec, padding fraction {1 - metric[0] / metric[1]:.3f}')
+
 net = BERTClassifier(bert)
+print('pad to max_len:')
+benchmark_encoder(net, train_iter, devices[0])
+print('bucketing + pad to longest:')
+benchmark_encoder(net, bucket_train_iter, devices[0])
+
 lr, num_epochs = 1e-4, 5
 trainer = torch.optim.Adam(net.parameters(), lr=lr)
 loss = nn.CrossEntropyLoss(reduction='none')
-common.train_ch13(net, train_iter, test_iter, loss, trainer, num_epochs, devices, print_all_log=True)
+common.train_ch13(net, bucket_train_iter, bucket_test_iter, loss, trainer, num_epochs, devices,
+                  print_all_log=True)
 plt.show()
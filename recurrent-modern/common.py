@@ -369,6 +369,20 @@ class Decoder(nn.Module):
     def init_state(self, enc_outputs, *args):
         raise NotImplementedError
 
+    def reorder_state(self, state, index):
+        """按index沿batch维度挑选或重排解码器状态，用于批量解码和束搜索
+
+        默认实现递归处理列表和元组：张量沿第0维挑选，None保持不变，
+        其他对象调用它自己的index_select(index)；
+        batch不在第0维的状态（如循环神经网络的隐状态）需要在子类中重写"""
+        if state is None:
+            return None
+        if isinstance(state, torch.Tensor):
+            return state.index_select(0, index)
+        if isinstance(state, (list, tuple)):
+            return type(state)(self.reorder_state(s, index) for s in state)
+        return state.index_select(index)
+
     def foward(self, X, state):
         raise NotImplementedError
 
@@ -383,3 +397,154 @@ class EncoderDecoder(nn.Module):
         enc_outputs = self.encoder(enc_X, *args)
         dec_state = self.decoder.init_state(enc_outputs, *args)
         return self.decoder(dec_X, dec_state)
+
+# 批量预测
+def _init_dec_state(net, src_sentences, src_vocab, num_steps, device):
+    """把一批源句子按predict_seq2seq的方式填充后运行一次编码器，返回解码器的初始状态"""
+    src_tokens = [src_vocab[sentence.lower().split(' ')] + [src_vocab['<eos>']]
+                  for sentence in src_sentences]
+    enc_valid_len = torch.tensor([min(len(tokens), num_steps) for tokens in src_tokens],
+                                 device=device)
+    # enc_X: (num_sentences, num_steps)
+    enc_X = torch.tensor([truncate_pad(tokens, num_steps, src_vocab['<pad>'])
+                          for tokens in src_tokens], dtype=torch.long, device=device)
+    enc_outputs = net.encoder(enc_X, enc_valid_len)
+    return net.decoder.init_state(enc_outputs, enc_valid_len, num_steps)
+
+def _to_translation(seq, tgt_vocab):
+    """截掉第一个<eos>及其之后的词元"""
+    eos = tgt_vocab['<eos>']
+    if eos in seq:
+        seq = seq[:seq.index(eos)]
+    return ' '.join(tgt_vocab.to_tokens(seq))
+
+def translate_batch(net, src_sentences, src_vocab, tgt_vocab, num_steps, device,
+                    batch_size=256, compact_every=4):
+    """批量贪心解码：每批句子填充后只运行一次编码器，再同步地逐词解码
+
+    已经输出<eos>的句子记在设备上的finished中，解码过程不逐步同步到CPU；
+    每compact_every步检查一次，用decoder.reorder_state把译完的句子从batch中剔除
+    """
+    net.eval()
+    timer = d2l.Timer()
+    eos, translations = tgt_vocab['<eos>'], []
+    with torch.no_grad():
+        for start in range(0, len(src_sentences), batch_size):
+            sentences = src_sentences[start:start + batch_size]
+            num_sentences = len(sentences)
+            dec_state = _init_dec_state(net, sentences, src_vocab, num_steps, device)
+            # dec_X: (num_active, 1)
+            dec_X = torch.full((num_sentences, 1), tgt_vocab['<bos>'], dtype=torch.long, device=device)
+            # rows: 仍在解码的句子在本批中的下标，finished: 这些句子是否已经输出过<eos>
+            rows = torch.arange(num_sentences, device=device)
+            finished = torch.zeros(num_sentences, dtype=torch.bool, device=device)
+            # output_seq: (num_sentences, num_steps)，没有写入的位置保持为<eos>
+            output_seq = torch.full((num_sentences, num_steps), eos, dtype=torch.long, device=device)
+            for step in range(num_steps):
+                Y, dec_state = net.decoder(dec_X, dec_state)
+                # 已经译完但还没被剔除的句子一直输出<eos>
+                dec_X = Y.argmax(dim=2).masked_fill(finished.unsqueeze(1), eos)
+                output_seq[rows, step] = dec_X[:, 0]
+                finished |= dec_X[:, 0] == eos
+                if (step + 1) % compact_every == 0 and step + 1 < num_steps:
+                    # 只在这里同步一次，剔除译完的句子
+                    keep = torch.nonzero(~finished).squeeze(1)
+                    if len(keep) == 0:
+                        break
+                    if len(keep) < len(rows):
+                        rows, finished, dec_X = rows[keep], finished[keep], dec_X[keep]
+                        dec_state = net.decoder.reorder_state(dec_state, keep)
+            translations.extend(_to_translation(seq, tgt_vocab) for seq in output_seq.tolist())
+    print(f'{len(src_sentences) / timer.stop():.1f} sentences/sec on {str(device)}')
+    return translations
+
+def beam_search(net, src_sentences, src_vocab, tgt_vocab, num_steps, device, beam_size=4,
+                alpha=0.75, early_stopping=True, batch_size=64, compact_every=4):
+    """批量束搜索：把batch_size个句子的beam_size个候选合并成batch_size * beam_size行同时解码
+
+    每一步从每个句子的beam_size * vocab_size个扩展中选出得分（对数概率之和）最高的beam_size个，
+    并用decoder.reorder_state按所选候选的来源重排解码器状态。
+    以<eos>结束的候选只能继续接<eos>且得分不变；一个句子的搜索结束时，在已经结束的候选中
+    按score / L^alpha选出最好的候选，L为包括<eos>在内的输出长度，alpha为长度惩罚，
+    到num_steps仍没有候选结束的句子才在所有候选中选择。
+    early_stopping为True时，一个句子得分最高的候选结束后就停止搜索这个句子，
+    否则要等它的所有候选都结束。结果在搜索结束的那一步确定，与compact_every无关
+    """
+    net.eval()
+    timer = d2l.Timer()
+    eos, k, translations, num_tokens = tgt_vocab['<eos>'], beam_size, [], 0
+    with torch.no_grad():
+        for start in range(0, len(src_sentences), batch_size):
+            sentences = src_sentences[start:start + batch_size]
+            num_sentences = len(sentences)
+            dec_state = _init_dec_state(net, sentences, src_vocab, num_steps, device)
+            # 每个句子的状态复制beam_size份，第i个句子的候选位于第i * k到i * k + k - 1行
+            dec_state = net.decoder.reorder_state(
+                dec_state, torch.arange(num_sentences, device=device).repeat_interleave(k))
+            dec_X = torch.full((num_sentences * k, 1), tgt_vocab['<bos>'], dtype=torch.long, device=device)
+            # rows: 仍在搜索的句子在本批中的下标
+            rows = torch.arange(num_sentences, device=device)
+            # scores, lengths, finished: (num_active, k)，一开始只保留每个句子的第一个候选
+            scores = torch.full((num_sentences, k), float('-inf'), device=device)
+            scores[:, 0] = 0
+            lengths = torch.zeros((num_sentences, k), dtype=torch.long, device=device)
+            finished = torch.zeros((num_sentences, k), dtype=torch.bool, device=device)
+            # history: (num_active * k, num_steps)，各候选已经输出的词元
+            history = torch.full((num_sentences * k, num_steps), eos, dtype=torch.long, device=device)
+            # done: (num_active,)，搜索已经结束的句子，它们选出的候选在结束的那一步写入best_seqs
+            done = torch.zeros(num_sentences, dtype=torch.bool, device=device)
+            best_seqs = torch.full((num_sentences, num_steps), eos, dtype=torch.long, device=device)
+            for step in range(num_steps):
+                Y, dec_state = net.decoder(dec_X, dec_state)
+                num_active, vocab_size = scores.shape[0], Y.shape[-1]
+                # log_probs: (num_active, k, vocab_size)
+                log_probs = nn.functional.log_softmax(Y[:, -1], dim=-1).reshape(num_active, k, -1)
+                # 已经结束的候选只能接<eos>，且得分不变
+                eos_only = torch.full((vocab_size,), float('-inf'), device=device)
+                eos_only[eos] = 0
+                log_probs = torch.where(finished.unsqueeze(-1), eos_only, log_probs)
+                # 在每个句子的k * vocab_size个扩展中选得分最高的k个
+                scores, index = (scores.unsqueeze(-1) + log_probs).reshape(num_active, -1).topk(k, dim=1)
+                beam, token = index // vocab_size, index % vocab_size
+                # parent: (num_active * k)，所选候选来自哪一行
+                parent = (torch.arange(num_active, device=device).unsqueeze(1) * k + beam).reshape(-1)
+                prev_finished = finished.reshape(-1)[parent].reshape(num_active, k)
+                lengths = lengths.reshape(-1)[parent].reshape(num_active, k) + (~prev_finished).long()
+                finished = prev_finished | (token == eos)
+                history = history[parent]
+                history[:, step] = token.reshape(-1)
+                dec_X = token.reshape(-1, 1)
+                dec_state = net.decoder.reorder_state(dec_state, parent)
+                last_step = step + 1 == num_steps
+                if last_step:
+                    now_done = torch.ones_like(done)
+                elif early_stopping:
+                    # topk的结果按得分降序排列，第0个候选就是得分最高的候选
+                    now_done = finished[:, 0]
+                else:
+                    now_done = finished.all(dim=1)
+                # 在设备上把这一步结束搜索的句子的最好候选写入best_seqs，不需要同步
+                # 按长度惩罚后的得分只在结束的候选中选择，没有候选结束的句子才在所有候选中选择
+                normalized = scores / lengths.clamp(min=1).float().pow(alpha)
+                candidates = finished | ~finished.any(dim=1, keepdim=True)
+                best = normalized.masked_fill(~candidates, float('-inf')).argmax(dim=1)
+                selected = history.reshape(num_active, k, -1)[torch.arange(num_active, device=device), best]
+                newly_done = (now_done & ~done).unsqueeze(1)
+                best_seqs[rows] = torch.where(newly_done, selected, best_seqs[rows])
+                done = done | now_done
+                if (step + 1) % compact_every == 0 and not last_step:
+                    # 只在这里同步一次，把搜索结束的句子剔除
+                    keep = torch.nonzero(~done).squeeze(1)
+                    if len(keep) == 0:
+                        break
+                    if len(keep) < num_active:
+                        keep_rows = (keep.unsqueeze(1) * k + torch.arange(k, device=device)).reshape(-1)
+                        rows, scores, lengths, finished = rows[keep], scores[keep], lengths[keep], finished[keep]
+                        done, history, dec_X = done[keep], history[keep_rows], dec_X[keep_rows]
+                        dec_state = net.decoder.reorder_state(dec_state, keep_rows)
+            for seq in best_seqs.tolist():
+                translation = _to_translation(seq, tgt_vocab)
+                num_tokens += len(translation.split()) + 1
+                translations.append(translation)
+    print(f'{num_tokens / timer.stop():.1f} tokens/sec on {str(device)}')
+    return translations
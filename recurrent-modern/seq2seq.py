@@ -45,6 +45,10 @@ class Seq2SeqDecoder(common.Decoder):
     def init_state(self, enc_outputs, *args):
         return enc_outputs[1]
 
+    def reorder_state(self, state, index):
+        # state: (num_layers, batch_size, num_hiddens)
+        return state.index_select(1, index)
+
     # # X: (batch_size, num_steps)
     def forward(self, X, state):
         # X: (num_steps, batch_size, embed_size)
@@ -207,9 +211,13 @@ def bleu(pred_seq, label_seq, k):
 
 engs = ['go .', "i lost .", 'he\'s calm .', 'i\'m home .']
 fras = ['va !', 'j\'ai perdu .', 'il est calme .', 'je suis chez moi .']
-for eng, fra in zip(engs, fras):
-    translation, attention_weight_seq = predict_seq2seq(
-        net, eng, src_vocab, tgt_vocab, num_steps, device)
+# 批量贪心解码，Seq2SeqDecoder实现了reorder_state
+translations = common.translate_batch(net, engs, src_vocab, tgt_vocab, num_steps, device)
+for eng, fra, translation in zip(engs, fras, translations):
     print(f"{eng} => {translation}, bleu {bleu(translation, fra, k=2):.3f}")
+# 束搜索
+translations = common.beam_search(net, engs, src_vocab, tgt_vocab, num_steps, device, beam_size=3)
+for eng, fra, translation in zip(engs, fras, translations):
+    print(f"beam search: {eng} => {translation}, bleu {bleu(translation, fra, k=2):.3f}")
 
 plt.show()